@@ -8,28 +8,53 @@ from commands import (actions, actions_config, actions_trip, actions_booking,
                       actions_mytrips, actions_mybookings, actions_notifications,
                       actions_request, actions_seerequests, actions_myrequests,
                       actions_admin)
-from data.database_api import is_banned
+from data.database_api import (is_banned, load_mirrors, refresh_mirrors,
+                                roll_week_mirrors, is_unreachable, set_reachable,
+                                refresh_tg_username)
+from messages.message_queue import MessageQueue, MQ_OUTBOX_PATH
+from messages.outbox import Outbox
+from data.request_scope import begin_request_scope, end_request_scope
+from data.archive import archive_old_data, ARCHIVE_SCHEDULED
+from data.storage import set_backend, MemoryBackend
+from messages.notifications import debug_group_notify
 from time import time
+from datetime import time as dt_time
+from utils.common import madrid
 
 PORT = int(environ.get('PORT', '8443'))
 TOKEN = environ["TOKEN"]
 NAME = 'benaluma-bot'
-
-ENV_KEYS = {
-    "type": "service_account",
-    "project_id": environ["FIREBASE_PROJECT_ID"],
-    "private_key_id": environ["FIREBASE_PRIVATE_KEY_ID"],
-    "private_key": environ["FIREBASE_PRIVATE_KEY"].replace("\\n", "\n"),
-    "client_email": environ["FIREBASE_CLIENT_EMAIL"],
-    "client_id": environ["FIREBASE_CLIENT_ID"],
-    "token_uri": environ["FIREBASE_TOKEN_URI"],
-}
-
-# Setup Firebase database
-firebase_admin.initialize_app(
-    firebase_admin.credentials.Certificate(ENV_KEYS),
-    {'databaseURL': environ["FIREBASE_DATABASE_URL"]}
-)
+# Keep in-memory mirrors updated through Firebase streaming or through polling
+FIREBASE_STREAMING = environ.get('FIREBASE_STREAMING', '1') != '0'
+MIRROR_REFRESH_INTERVAL = int(environ.get('MIRROR_REFRESH_INTERVAL', '60'))
+
+# Storage backend: 'firebase', or 'memory' to run locally without a Firebase
+# project, for example for load tests
+STORAGE_BACKEND = environ.get('STORAGE_BACKEND', 'firebase')
+
+if STORAGE_BACKEND == 'memory':
+    # Optionally start from a JSON export of the database
+    data = None
+    if 'MEMORY_STORAGE_DATA' in environ:
+        with open(environ['MEMORY_STORAGE_DATA'], encoding='utf-8') as file:
+            data = json.load(file)
+    set_backend(MemoryBackend(data))
+else:
+    ENV_KEYS = {
+        "type": "service_account",
+        "project_id": environ["FIREBASE_PROJECT_ID"],
+        "private_key_id": environ["FIREBASE_PRIVATE_KEY_ID"],
+        "private_key": environ["FIREBASE_PRIVATE_KEY"].replace("\\n", "\n"),
+        "client_email": environ["FIREBASE_CLIENT_EMAIL"],
+        "client_id": environ["FIREBASE_CLIENT_ID"],
+        "token_uri": environ["FIREBASE_TOKEN_URI"],
+    }
+
+    # Setup Firebase database
+    firebase_admin.initialize_app(
+        firebase_admin.credentials.Certificate(ENV_KEYS),
+        {'databaseURL': environ["FIREBASE_DATABASE_URL"]}
+    )
 
 # Enable logging
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -47,7 +72,9 @@ def text_handler(update, context):
 
 def callback(update, context):
     """Checks whether user is banned to let they use the bot or not.
-    Also checks if the message comes from a private conversation or the debug group"""
+    Also checks if the message comes from a private conversation or the debug group,
+    clears the unreachable mark of users who had blocked the bot and records
+    username changes"""
     # Check banned users
     if is_banned(update.effective_chat.id):
         restrict_until = context.user_data.get("restrictUntil", 0)
@@ -58,6 +85,9 @@ def callback(update, context):
         else:
             update.effective_message.reply_text("Estás baneado. No puedes usar el bot.")
         raise DispatcherHandlerStop
+    # Users who had blocked the bot can receive messages again
+    if is_unreachable(update.effective_chat.id):
+        set_reachable(update.effective_chat.id)
     # Check private chats
     if update.effective_chat.type != 'private':
         if not ("DEBUG_GROUP_CHAT_ID" in environ and
@@ -65,19 +95,71 @@ def callback(update, context):
             text = "Para usarme, escríbeme un mensaje privado a @BenalUMA_bot."
             update.message.reply_text(text)
             raise DispatcherHandlerStop
+    # Keep the usernames index up to date when users change their username
+    if update.effective_user:
+        refresh_tg_username(update.effective_user.id, update.effective_user.username)
+
+def begin_scope_callback(update, context):
+    """Starts the database reads cache of the update, described by its type
+    and ID, so no user input ends up in the logs."""
+    if update.callback_query:
+        kind = "Callback query"
+    elif update.effective_message and update.effective_message.text \
+            and update.effective_message.text.startswith('/'):
+        kind = "Command"
+    else:
+        kind = "Update"
+    begin_request_scope(f"{kind} {update.update_id}")
+
+def end_scope_callback(update, context):
+    """Ends the database reads cache of the update, logging its calls count."""
+    end_request_scope()
 
 def error(update, context):
     """Log Errors caused by Updates."""
     logger.warning('Update "%s" caused error "%s"', update, context.error)
 
+def refresh_mirrors_job(context):
+    """Reloads the in-memory copies of the database when streaming is disabled."""
+    refresh_mirrors()
+
+def roll_week_mirrors_job(context):
+    """Moves the in-memory copies of the trips and requests to the new week."""
+    roll_week_mirrors()
+
+def archive_job(context):
+    """Moves the old trips and requests to the local archive."""
+    report = archive_old_data()
+    if report['Trips'] or report['Requests']:
+        debug_group_notify(context, actions_admin.format_archive_report(report))
+
 def main(webhook_flag = True):
     """Start the bot."""
     # Create the Updater and pass it your bot's token.
     updater = Updater(TOKEN)
 
+    # Load the in-memory copies of the most read database nodes
+    load_mirrors(FIREBASE_STREAMING)
+    if not FIREBASE_STREAMING:
+        updater.job_queue.run_repeating(refresh_mirrors_job, MIRROR_REFRESH_INTERVAL,
+                                        first=MIRROR_REFRESH_INTERVAL)
+    updater.job_queue.run_daily(roll_week_mirrors_job, dt_time(0, 0, 5, tzinfo=madrid))
+    # Archive the old data at night, when the bot is barely used
+    if ARCHIVE_SCHEDULED:
+        updater.job_queue.run_daily(archive_job, dt_time(4, 0, tzinfo=madrid))
+
     # Get the dispatcher to register handlers
     dp = updater.dispatcher
 
+    # Create the outgoing messages queue, which resends the messages that
+    # were still pending when the bot was stopped
+    dp.bot_data['message_queue'] = MessageQueue(updater.job_queue,
+                                                Outbox(MQ_OUTBOX_PATH))
+
+    # Cache the database reads done while handling each update
+    dp.add_handler(TypeHandler(Update, begin_scope_callback), -2)
+    dp.add_handler(TypeHandler(Update, end_scope_callback), 99)
+
     # Add a handler in a higher priority group to avoid banned users from using the bot
     handler = TypeHandler(Update, callback)
     dp.add_handler(handler, -1)
@@ -2,11 +2,11 @@ import logging, telegram
 from telegram import ReplyKeyboardMarkup, ReplyKeyboardRemove, Update
 from telegram.ext import (Updater, CommandHandler, MessageHandler, Filters,
                                 ConversationHandler, CallbackContext)
-from data.database_api import (add_user, set_tg_username, add_driver,
+from data.database_api import (add_user, add_driver,
                                 is_registered, is_driver, set_fee,
                                 modify_offer_notification,
                                 modify_request_notification)
-from messages.message_queue import send_message
+from messages.message_queue import send_message, PRIORITY_INTERACTIVE
 from messages.notifications import debug_group_notify
 from messages.format import get_formatted_user_config
 from utils.common import *
@@ -50,9 +50,7 @@ def register_in_db(update, context, name, is_driver=False, slots=None, car=None)
     """Auxiliar function to process the registration in the database"""
     chat_id = update.effective_chat.id
 
-    add_user(chat_id, name)
-    if update.effective_user.username:
-        set_tg_username(chat_id, update.effective_user.username)
+    add_user(chat_id, name, update.effective_user.username)
 
     if is_driver:
         add_driver(chat_id, slots, car)
@@ -70,7 +68,7 @@ def register_in_db(update, context, name, is_driver=False, slots=None, car=None)
                f" por defecto para que se te avise cada vez que alguien realiza una"\
                f" nueva petición de viaje. Puedes cambiar esta configuración con el"\
                f" comando /notificaciones."
-        send_message(context, chat_id, text)
+        send_message(context, chat_id, text, priority=PRIORITY_INTERACTIVE)
     else:
         for key in dir_dict:
             modify_offer_notification(chat_id, key)
@@ -82,7 +80,7 @@ def register_in_db(update, context, name, is_driver=False, slots=None, car=None)
                f" por defecto para que se te avise cada vez que un nuevo viaje"\
                f" sea publicado. Puedes cambiar esta configuración con el comando"\
                f" /notificaciones."
-        send_message(context, chat_id, text)
+        send_message(context, chat_id, text, priority=PRIORITY_INTERACTIVE)
 
     text = f"Un aviso antes de que empieces a ofertar/reservar viajes:\nEste"\
            f" bot necesita poder enlazar a tu perfil para que los demás"\
@@ -93,7 +91,8 @@ def register_in_db(update, context, name, is_driver=False, slots=None, car=None)
            f" en **'Privacidad y Seguridad' \> 'Mensajes reenviados'**, tengas"\
            f" marcada la opción __Todos__ o, al menos, añadas este bot como "\
            f" excepción\.\n¡Buen viaje\!"
-    send_message(context, chat_id, text, parse_mode=telegram.ParseMode.MARKDOWN_V2)
+    send_message(context, chat_id, text, parse_mode=telegram.ParseMode.MARKDOWN_V2,
+                    priority=PRIORITY_INTERACTIVE)
 
     debug_text = f"El usuario con ID `{chat_id}` se ha"\
                  f" registrado con la siguiente configuración:\n\n"\
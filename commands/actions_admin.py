@@ -5,10 +5,16 @@ from telegram.ext import (Updater, CommandHandler, MessageHandler, Filters,
 from telegram.utils.helpers import escape_markdown
 from data.database_api import (is_registered, is_driver, ban_user, is_banned,
                                 unban_user, get_chat_id_from_tg_username,
-                                get_all_chat_ids)
+                                get_all_chat_ids, get_cache_stats,
+                                filter_reachable, backfill_username_index)
+from data.consistency import check_index_consistency
+from data.archive import archive_old_data
+from data.history import trip_history
 from messages.format import get_formatted_user_config
 from messages.notifications import delete_driver_notify, delete_user_notify
-from messages.message_queue import send_message
+from messages.message_queue import (send_message, get_message_queue,
+                                    PRIORITY_TRANSACTIONAL, PRIORITY_INTERACTIVE,
+                                    PRIORITY_BULK)
 from utils.common import *
 from utils.decorators import admin
 
@@ -45,7 +51,7 @@ def ban(update, context):
     ban_user(user_id)
     text_user = f"⛔ Has sido baneado. Tu cuenta se ha eliminado y no puedes"\
                 f" volver a usar el bot."
-    send_message(context, user_id, text_user)
+    send_message(context, user_id, text_user, priority=PRIORITY_TRANSACTIONAL)
     text = f"El usuario con ID `{user_id}` ha sido baneado\."
     update.message.reply_text(text, parse_mode=telegram.ParseMode.MARKDOWN_V2)
     return
@@ -72,7 +78,7 @@ def unban(update, context):
     unban_user(user_id)
     text_user = f"🆗 Has sido desbaneado. Puedes volver a crearte una cuenta"\
                 f" si lo deseas."
-    send_message(context, user_id, text_user)
+    send_message(context, user_id, text_user, priority=PRIORITY_TRANSACTIONAL)
     text = f"El usuario con ID `{user_id}` ha sido desbaneado\."
     update.message.reply_text(text, parse_mode=telegram.ParseMode.MARKDOWN_V2)
     return
@@ -86,7 +92,8 @@ def broadcast(update, context):
 
     # message = ' '.join(context.args)
     message = update.message.text.split(" ",1)[1]
-    send_message(context, get_all_chat_ids(), message)
+    send_message(context, filter_reachable(get_all_chat_ids()), message,
+                    priority=PRIORITY_BULK)
 
     return
 
@@ -116,14 +123,128 @@ def dm(update, context):
         return
 
     message = update.message.text.split(" ",2)[2]
-    send_message(context, user_id, message, notify_id=update.effective_chat.id)
+    send_message(context, user_id, message, notify_id=update.effective_chat.id,
+                    priority=PRIORITY_INTERACTIVE)
 
     text = f"Enviando mensaje a usuario con ID `{user_id}`\."
     update.message.reply_text(text, parse_mode=telegram.ParseMode.MARKDOWN_V2)
     return
 
+@admin
+def stats(update, context):
+    """Shows the usage statistics of the bot's internal caches"""
+    lines = []
+    for name, cache_stats in get_cache_stats().items():
+        total = cache_stats['hits'] + cache_stats['misses']
+        hit_rate = 100*cache_stats['hits']/total if total else 0
+        lines.append(f"{name}: {cache_stats['size']} entradas, "\
+                     f"{cache_stats['hits']} aciertos, {cache_stats['misses']} "\
+                     f"fallos ({hit_rate:.0f}%)")
+    text = "Cachés:\n" + "\n".join(lines)
+    mq_stats = get_message_queue(context).stats()
+    text += f"\n\nCola de mensajes: {mq_stats['queued']} en cola, "\
+            f"{mq_stats['sent']} enviados, espera media {mq_stats['avg_wait']:.1f} s"\
+            f" (máxima {mq_stats['max_wait']:.1f} s)"
+    for name, queued in mq_stats['queued_by_priority'].items():
+        if queued:
+            text += f"\n{name}: {queued} en cola"
+    if 'outbox' in mq_stats:
+        text += f"\nOutbox: {mq_stats['outbox']['pending']} pendientes, "\
+                f"{mq_stats['outbox']['failed']} fallidos"
+    update.message.reply_text(text)
+    return
+
+@admin
+def check_db(update, context):
+    """Looks for orphaned and missing index entries in the database and, if
+    'fix' is given as a command parameter, repairs them"""
+    repair = bool(context.args) and context.args[0].lower() == 'fix'
+    result = check_index_consistency(repair)
+    orphans, missing = result['Orphaned'], result['Missing']
+    lines = [f"{index_type}: {count}" for index_type, count in orphans.items()]
+    text = "Entradas de índice huérfanas:\n" + "\n".join(lines)
+    lines = [f"{index_type}: {count}" for index_type, count in missing.items()]
+    text += "\n\nEntradas de índice que faltan:\n" + "\n".join(lines)
+    if repair:
+        text += "\n\nLas entradas huérfanas han sido eliminadas y las que"\
+                " faltaban han sido añadidas."
+    elif any(orphans.values()) or any(missing.values()):
+        text += "\n\nUsa /checkdb fix para repararlas."
+    update.message.reply_text(text)
+    return
+
+def format_archive_report(report):
+    """Builds the text describing the result of an archival."""
+    return f"Archivados {report['Trips']} viajes y {report['Requests']} peticiones"\
+           f" antiguos, con {report['Indexes']} entradas de índice. Liberados"\
+           f" {report['Reclaimed']/1024:.1f} KB de la base de datos"\
+           f" ({report['Archived']/1024:.1f} KB comprimidos en el archivo)."
+
+@admin
+def archive(update, context):
+    """Archives the old trips and requests. The number of days to keep can be
+    given as a command parameter"""
+    if context.args and not context.args[0].isdigit():
+        text = "Sintaxis incorrecta\. Uso: `/archive [días]`"
+        update.message.reply_text(text, parse_mode=telegram.ParseMode.MARKDOWN_V2)
+        return
+    report = archive_old_data(int(context.args[0]) if context.args else None)
+    update.message.reply_text(format_archive_report(report))
+    return
+
+@admin
+def reindex(update, context):
+    """Rebuilds the Telegram usernames index from the users' data"""
+    count = backfill_username_index()
+    update.message.reply_text(f"Índice de nombres de usuario reconstruido con"\
+                              f" {count} nombres.")
+    return
+
+@admin
+def history(update, context):
+    """Shows the statistics by weekday of the archived trips between two
+    dates (the last year by default), optionally of a single driver given
+    by its chat ID or telegram username"""
+    args = list(context.args or [])
+    driver_id = None
+    if args and not re.fullmatch(r"\d{4}-\d{2}-\d{2}", args[-1]):
+        driver_id = args.pop()
+        if driver_id[0]=='@':
+            driver_id = get_chat_id_from_tg_username(driver_id)
+    try:
+        date_end = date.fromisoformat(args[1]) if len(args)>1 else date.today()
+        date_start = date.fromisoformat(args[0]) if args else date_end-timedelta(days=365)
+    except ValueError:
+        date_start = None
+    if len(args)>2 or not date_start or (driver_id!=None and not str(driver_id).isdigit()):
+        text = "Sintaxis incorrecta\. Uso: `/history [desde] [hasta] [user_id/@username]`"\
+               "\nLas fechas tienen el formato `AAAA\-MM\-DD`\."
+        update.message.reply_text(text, parse_mode=telegram.ParseMode.MARKDOWN_V2)
+        return
+
+    result = trip_history.aggregate(date_start.isoformat(), date_end.isoformat(), driver_id)
+    lines = []
+    total = {key: sum(row[key] for row in result) for key in result[0]}
+    for weekday, row in zip(weekdays + ['Total'], result + [total]):
+        occupation = f", {100*row['Occupied']/row['Seats']:.0f}% de ocupación" \
+                                                    if row['Seats'] else ""
+        lines.append(f"{weekday}: {row['Trips']} viajes, {row['Passengers']}"\
+                     f" pasajeros{occupation}")
+    text = f"Viajes archivados del {date_start.strftime('%d/%m/%Y')} al "\
+           f"{date_end.strftime('%d/%m/%Y')}"
+    if driver_id:
+        text += f" del conductor {driver_id}"
+    text += ":\n\n" + "\n".join(lines)
+    update.message.reply_text(text)
+    return
+
 def add_handlers(dispatcher):
     dispatcher.add_handler(CommandHandler("ban", ban))
     dispatcher.add_handler(CommandHandler("unban", unban))
     dispatcher.add_handler(CommandHandler("broadcast", broadcast))
     dispatcher.add_handler(CommandHandler("dm", dm))
+    dispatcher.add_handler(CommandHandler("stats", stats))
+    dispatcher.add_handler(CommandHandler("checkdb", check_db))
+    dispatcher.add_handler(CommandHandler("archive", archive))
+    dispatcher.add_handler(CommandHandler("history", history))
+    dispatcher.add_handler(CommandHandler("reindex", reindex))
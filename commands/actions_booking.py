@@ -3,16 +3,16 @@ from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 from telegram.ext import (Updater, CommandHandler, MessageHandler, Filters,
                         ConversationHandler, CallbackContext, CallbackQueryHandler)
 from telegram.utils.helpers import escape_markdown
-from data.database_api import (get_name, get_slots, get_trip, get_trip_chat_id,
-                                get_number_of_passengers, get_trip_slots,
-                                add_passenger, is_passenger, get_trip_time,
+from data.database_api import (get_name, get_trip, get_trip_chat_id,
+                                reserve_seat, BookingResult,
+                                is_passenger, get_trip_time,
                                 get_requests_by_user_and_date, delete_request)
 from messages.format import (get_markdown2_inline_mention,
                           get_formatted_trip_for_passenger,
                           get_formatted_trip_for_driver,
                           get_formatted_offered_trips,
                           format_request_from_data)
-from messages.message_queue import send_message
+from messages.message_queue import send_message, PRIORITY_TRANSACTIONAL
 from utils.keyboards import (weekdays_keyboard, trip_ids_keyboard)
 from utils.time_picker import (time_picker_keyboard, process_time_callback)
 from utils.common import *
@@ -351,32 +351,30 @@ def alert_user(update, context):
         text_booker = ""
     # Check action
     elif action == "Y":
-        if is_passenger(user_id, dir, date, trip_key):
+        # Check capacity and add the passenger in a single atomic operation
+        result = reserve_seat(user_id, dir, date, trip_key)
+        if result == BookingResult.TRIP_GONE:
+            text = escape_markdown(f"⚠️ Este viaje ya no existe.",2)
+            text_booker = ""
+        elif result == BookingResult.ALREADY_PASSENGER:
             text = f"⚠️ No puedes aceptar a este usuario porque ya es un"\
                    f" pasajero confirmado para este viaje."
             text = escape_markdown(text,2)
             text_booker = ""
-        else:
-            slots = get_trip_slots(dir, date, trip_key)
-            if slots==None:
-                slots = get_slots(driver_id)
-            slots -= get_number_of_passengers(dir, date, trip_key)
-
-            if slots > 0: # If trip is not full, it accepts the passenger
-                add_passenger(user_id, dir, date, trip_key)
-                text = escape_markdown("¡Hecho! Tienes una nueva plaza reservada.\n\n",2)
-                text += get_formatted_trip_for_driver(dir, date, trip_key)
-                text_booker = f"¡Enhorabuena! Te han confirmado la reserva para "\
-                              f"el siguiente viaje.\n\n"
-                reservation_ok = True
-            else:
-                text = f"⚠️ Atención, no te quedan plazas para este viaje. No es "\
-                       f"posible confirmar esta reserva."
-                text = escape_markdown(text,2)
-                text_booker = f"⚠️ Atención, no se ha podido confirmar la reserva "\
-                              f"porque no quedan más plazas libres. Contacta con el "\
-                              f"conductor pulsando sobre su nombre si quieres "\
-                              f"preguntarle sobre la disponibilidad.\n\n"
+        elif result == BookingResult.OK:
+            text = escape_markdown("¡Hecho! Tienes una nueva plaza reservada.\n\n",2)
+            text += get_formatted_trip_for_driver(dir, date, trip_key)
+            text_booker = f"¡Enhorabuena! Te han confirmado la reserva para "\
+                          f"el siguiente viaje.\n\n"
+            reservation_ok = True
+        else: # If trip is full, the passenger can't be accepted
+            text = f"⚠️ Atención, no te quedan plazas para este viaje. No es "\
+                   f"posible confirmar esta reserva."
+            text = escape_markdown(text,2)
+            text_booker = f"⚠️ Atención, no se ha podido confirmar la reserva "\
+                          f"porque no quedan más plazas libres. Contacta con el "\
+                          f"conductor pulsando sobre su nombre si quieres "\
+                          f"preguntarle sobre la disponibilidad.\n\n"
     elif action == "N":
         text = escape_markdown("🚫 Has rechazado la petición de reserva.",2)
         text_booker = f"❌ Tu petición de reserva para el siguiente viaje ha"\
@@ -389,7 +387,7 @@ def alert_user(update, context):
         text_booker += get_formatted_trip_for_passenger(dir, date, trip_key,
                                         is_abbreviated = not reservation_ok)
         send_message(context, user_id, text_booker, telegram.ParseMode.MARKDOWN_V2,
-                            notify_id = driver_id)
+                            notify_id = driver_id, priority=PRIORITY_TRANSACTIONAL)
         if reservation_ok:
             # Check if passenger had any trip requests near this trip,
             # delete it and notify the deletion to passenger
@@ -405,7 +403,8 @@ def alert_user(update, context):
                     text_booker2 += format_request_from_data(dir, date,
                                                     time=req_dict[key]['Time'])
                     send_message(context, user_id, text_booker2,
-                                            telegram.ParseMode.MARKDOWN_V2)
+                                            telegram.ParseMode.MARKDOWN_V2,
+                                            priority=PRIORITY_TRANSACTIONAL)
 
 def reserve_from_notification(update, context):
     """Gateway to SO_review when booking from a new trip notification"""
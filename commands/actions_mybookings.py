@@ -8,7 +8,7 @@ from messages.format import (get_markdown2_inline_mention,
                           get_formatted_trip_for_driver,
                           get_formatted_trip_for_passenger,
                           get_user_week_formatted_bookings)
-from messages.message_queue import send_message
+from messages.message_queue import send_message, PRIORITY_TRANSACTIONAL
 from utils.keyboards import trips_keyboard
 from utils.common import *
 from utils.decorators import registered, send_typing_action
@@ -154,7 +154,7 @@ def MB_execute_action(update, context):
                       f"anulado su reserva en el siguiente viaje:\n\n"
         text_driver += get_formatted_trip_for_driver(direction, date, trip_key)
         send_message(context, driver_id, text_driver, telegram.ParseMode.MARKDOWN_V2,
-                        notify_id = chat_id)
+                        notify_id = chat_id, priority=PRIORITY_TRANSACTIONAL)
 
     # Remove elements from user's dictionary
     for key in list(context.user_data.keys()):
@@ -152,7 +152,8 @@ def publish_request(update, context):
     text += escape_markdown(text2, 2)
     query.edit_message_text(text=text, parse_mode=telegram.ParseMode.MARKDOWN_V2)
 
-    notify_new_request(context, dir, update.effective_chat.id, date, time)
+    notify_new_request(context, dir, update.effective_chat.id, date, time,
+                        request_key)
 
     for key in list(context.user_data.keys()):
         if key.startswith('request_'):
@@ -0,0 +1,228 @@
+import logging, os, json, gzip
+from datetime import datetime, timedelta
+from data.database_api import multi_path_update, get_slots
+from data.request_scope import ScopedReference
+from utils.common import dir_dict, madrid
+
+logger = logging.getLogger(__name__)
+
+# Folder of the archive files, one gzip-compressed JSON Lines file per month
+ARCHIVE_PATH = os.environ.get('ARCHIVE_PATH', 'archive')
+# The nightly archive deletes the archived items from the database, so it is
+# only scheduled when the folder is set explicitly, pointing to a persistent disk
+ARCHIVE_SCHEDULED = 'ARCHIVE_PATH' in os.environ
+# Trips and requests are archived this number of days after their date
+ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS', '7'))
+# Maximum number of paths deleted in each atomic update
+ARCHIVE_BATCH_SIZE = 500
+
+def _get_old_dates(path, cutoff):
+    """Gets the dates stored under a node which are previous to the cutoff.
+
+    Parameters
+    ----------
+    path : string
+        Database path of a direction node, such as '/Trips/toUMA'.
+    cutoff : string
+        First date to keep, with ISO format 'YYYY-mm-dd'.
+
+    Returns
+    -------
+    list(str)
+        Sorted dates previous to the cutoff.
+
+    """
+    dates_dict = ScopedReference(path).get(shallow=True)
+    if not isinstance(dates_dict, dict):
+        return list()
+    return sorted(date for date in dates_dict if date < cutoff)
+
+def _index_paths(node, direction, date, items_dict):
+    """Obtains the index entries of a date's trips or requests, which are
+    deleted along with them.
+
+    Parameters
+    ----------
+    node : string
+        'Trips' or 'Requests'.
+    direction : string
+        Direction of the items. Can be 'toBenalmadena' or 'toUMA'.
+    date : string
+        Date of the items with ISO format 'YYYY-mm-dd'.
+    items_dict : dict
+        Items of the date, keyed by their unique keys.
+
+    Returns
+    -------
+    set(str)
+        Database paths of the drivers', passengers' or users' date indexes.
+
+    """
+    paths = set()
+    for item in items_dict.values():
+        if not isinstance(item, dict):
+            continue
+        if node == 'Trips':
+            paths.add(f"/Drivers/{item['Chat ID']}/Offers/{direction}/{date}")
+            for passenger_id in item.get('Passengers', {}):
+                paths.add(f"/Passengers/{passenger_id}/{direction}/{date}")
+        else:
+            paths.add(f"/Users/{item['Chat ID']}/Requests/{direction}/{date}")
+    return paths
+
+def _get_seats(item, drivers_seats):
+    """Obtains the number of seats of an archived trip, which is the driver's
+    default one when the trip doesn't set it.
+
+    Parameters
+    ----------
+    item : dict
+        Trip information.
+    drivers_seats : dict
+        Default seats of the drivers already looked up, keyed by chat ID.
+
+    Returns
+    -------
+    int
+        Number of seats, or None if the driver no longer exists.
+
+    """
+    if item.get('Slots'):
+        return int(item['Slots'])
+    chat_id = str(item['Chat ID'])
+    if chat_id not in drivers_seats:
+        try:
+            drivers_seats[chat_id] = get_slots(chat_id)
+        except (TypeError, ValueError):
+            drivers_seats[chat_id] = None
+    return drivers_seats[chat_id]
+
+def _read_archived_keys(file_path):
+    """Reads the (Node, Direction, Date, Key) tuples of the records already
+    stored in an archive file.
+
+    Parameters
+    ----------
+    file_path : string
+        Path of the archive file.
+
+    Returns
+    -------
+    set(tuple)
+        Identifiers of the archived items.
+
+    """
+    keys = set()
+    if not os.path.exists(file_path):
+        return keys
+    try:
+        with gzip.open(file_path, 'rt', encoding='utf-8') as file:
+            for line in file:
+                record = json.loads(line)
+                keys.add((record['Node'], record['Direction'],
+                          record['Date'], record['Key']))
+    except (OSError, EOFError, ValueError) as e:
+        logger.warning(f"Could not read {file_path} completely: {str(e)}")
+    return keys
+
+def _write_archive(records, archived_keys):
+    """Appends records to the archive file of their month, skipping the ones
+    already archived by a previous run whose database deletion failed.
+
+    Parameters
+    ----------
+    records : list(dict)
+        Archived items, each one with a 'Date' field with ISO format.
+    archived_keys : dict
+        Keys of the records of each month's file, as returned by
+        `_read_archived_keys`. Filled as files are read and written.
+
+    Returns
+    -------
+    int
+        Number of compressed bytes written.
+
+    """
+    by_month = dict()
+    for record in records:
+        by_month.setdefault(record['Date'][:7], []).append(record)
+    os.makedirs(ARCHIVE_PATH, exist_ok=True)
+    written = 0
+    for month, month_records in by_month.items():
+        file_path = os.path.join(ARCHIVE_PATH, f"{month}.jsonl.gz")
+        if month not in archived_keys:
+            archived_keys[month] = _read_archived_keys(file_path)
+        keys = archived_keys[month]
+        month_records = [record for record in month_records
+                         if (record['Node'], record['Direction'], record['Date'],
+                             record['Key']) not in keys]
+        if not month_records:
+            continue
+        size = os.path.getsize(file_path) if os.path.exists(file_path) else 0
+        # Appending creates a new gzip member, which readers handle transparently
+        with gzip.open(file_path, 'at', encoding='utf-8') as file:
+            for record in month_records:
+                file.write(json.dumps(record, ensure_ascii=False) + '\n')
+        keys.update((record['Node'], record['Direction'], record['Date'],
+                     record['Key']) for record in month_records)
+        written += os.path.getsize(file_path) - size
+    return written
+
+def archive_old_data(days=None):
+    """Moves the trips and requests older than some days to the local archive
+    and deletes them, together with their drivers', passengers' and users'
+    index entries, in batches of atomic updates.
+
+    Parameters
+    ----------
+    days : int
+        Number of days after which items are archived. ARCHIVE_AFTER_DAYS
+        by default.
+
+    Returns
+    -------
+    dict
+        Number of archived 'Trips' and 'Requests', number of deleted index
+        entries ('Indexes'), and size in bytes of the deleted trips and
+        requests ('Reclaimed') and of the written archive ('Archived').
+
+    """
+    days = ARCHIVE_AFTER_DAYS if days is None else days
+    cutoff = (datetime.now(madrid).date() - timedelta(days=days)).isoformat()
+    report = {'Trips': 0, 'Requests': 0, 'Indexes': 0, 'Reclaimed': 0, 'Archived': 0}
+    # Each date is deleted with its index entries in the same update
+    pending = dict()
+    archived_keys = dict()
+    drivers_seats = dict()
+
+    for node in ['Trips', 'Requests']:
+        for direction in dir_dict:
+            for date in _get_old_dates(f"/{node}/{direction}", cutoff):
+                items_dict = ScopedReference(f"/{node}/{direction}/{date}").get()
+                if not isinstance(items_dict, dict):
+                    items_dict = dict()
+                records = [{'Node': node, 'Direction': direction, 'Date': date,
+                            'Key': key, 'Item': item}
+                           for key, item in items_dict.items()]
+                if node == 'Trips':
+                    for record in records:
+                        if isinstance(record['Item'], dict):
+                            record['Seats'] = _get_seats(record['Item'], drivers_seats)
+                # Items are only deleted once they are safely archived
+                report['Archived'] += _write_archive(records, archived_keys)
+                index_paths = _index_paths(node, direction, date, items_dict)
+                paths = [f"/{node}/{direction}/{date}"] + sorted(index_paths)
+                if len(pending) + len(paths) > ARCHIVE_BATCH_SIZE:
+                    multi_path_update(pending)
+                    pending = dict()
+                pending.update({path: None for path in paths})
+                report[node] += len(records)
+                report['Indexes'] += len(index_paths)
+                report['Reclaimed'] += len(json.dumps(items_dict).encode())
+    multi_path_update(pending)
+
+    if report['Trips'] or report['Requests']:
+        logger.info(f"Archived {report['Trips']} trips and {report['Requests']}"\
+                    f" requests previous to {cutoff}, reclaiming"\
+                    f" {report['Reclaimed']} bytes.")
+    return report
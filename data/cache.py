@@ -0,0 +1,98 @@
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+class TTLCache:
+    """Thread-safe key-value cache whose entries expire after some time.
+
+    When a maximum size is given, the least recently used entries are evicted
+    first. It also keeps hit and miss counters, useful to check how effective
+    the cache is.
+
+    Parameters
+    ----------
+    ttl : float
+        Seconds that an entry stays valid. If None, entries never expire.
+    maxsize : int
+        Maximum number of entries. If None, the size is not limited.
+
+    """
+
+    def __init__(self, ttl=None, maxsize=None):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _lookup(self, key):
+        """Returns (True, value) if key is cached and fresh, (False, None)
+        otherwise. Must be called with the lock held."""
+        if key in self._entries:
+            value, expiration = self._entries[key]
+            if expiration is None or expiration > monotonic():
+                self._entries.move_to_end(key)
+                return True, value
+            del self._entries[key]
+        return False, None
+
+    def get(self, key, loader=None):
+        """Gets the cached value for a key, loading it if necessary.
+
+        Parameters
+        ----------
+        key : hashable
+            The key to look for.
+        loader : callable
+            Optional. Function called with the key to obtain its value when it
+            is not cached. The result gets stored in the cache.
+
+        Returns
+        -------
+        object
+            The cached or loaded value. None if it is not cached and no loader
+            is given.
+
+        """
+        with self._lock:
+            found, value = self._lookup(key)
+            if found:
+                self.hits += 1
+                return value
+            self.misses += 1
+        if loader is None:
+            return None
+        value = loader(key)
+        self.set(key, value)
+        return value
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._lookup(key)[0]
+
+    def set(self, key, value):
+        """Stores a value in the cache, replacing any previous one."""
+        expiration = monotonic()+self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._entries[key] = (value, expiration)
+            self._entries.move_to_end(key)
+            if self.maxsize is not None:
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        """Removes a key from the cache, if present."""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """Removes all the entries from the cache."""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Returns a dictionary with the cache size and its hit/miss counters."""
+        with self._lock:
+            return {'size': len(self._entries), 'hits': self.hits,
+                    'misses': self.misses}
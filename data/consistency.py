@@ -0,0 +1,189 @@
+import logging
+from data.storage import get_backend
+from data.database_api import multi_path_update
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of paths written in each repairing update
+REPAIR_BATCH_SIZE = 500
+
+def _iterate_index(index_dict):
+    """Iterates over an index node with format {direction: {date: {key: True}}}.
+
+    Parameters
+    ----------
+    index_dict : dict
+        The index node content. It can be None.
+
+    Yields
+    ------
+    (string, string, string)
+        Direction, date and key of each index entry.
+
+    """
+    if not isinstance(index_dict, dict):
+        return
+    for dir, dir_dict in index_dict.items():
+        if not isinstance(dir_dict, dict):
+            continue
+        for date, date_dict in dir_dict.items():
+            if not isinstance(date_dict, dict):
+                continue
+            for key in date_dict:
+                yield dir, date, key
+
+def _get_item(items_dict, dir, date, key):
+    """Gets a trip or request from a {direction: {date: {key: item}}} dict."""
+    item = items_dict.get(dir, {}).get(date, {})
+    return item.get(key) if isinstance(item, dict) else None
+
+def find_orphaned_index_entries():
+    """Looks for index entries pointing to trips or requests that don't exist
+    anymore, or that don't belong to the index owner. These can appear if the
+    bot stops in the middle of a sequence of non-atomic writes.
+
+    Returns
+    -------
+    dict
+        Dictionary with the lists of orphaned paths, keyed by index type
+        ('Offers', 'Passengers' and 'Requests').
+
+    """
+    # The indexes are read before the items they point to. Items and index
+    # entries are created together, so a trip or request created in between
+    # is either in both snapshots or in none, and is never taken as orphaned
+    drivers = get_backend().reference("/Drivers").get() or dict()
+    passengers = get_backend().reference("/Passengers").get() or dict()
+    users = get_backend().reference("/Users").get() or dict()
+    trips = get_backend().reference("/Trips").get() or dict()
+    requests = get_backend().reference("/Requests").get() or dict()
+    orphans = {'Offers': [], 'Passengers': [], 'Requests': []}
+
+    # Drivers' offered trips
+    for driver_id, driver in drivers.items():
+        if not isinstance(driver, dict):
+            continue
+        for dir, date, key in _iterate_index(driver.get('Offers')):
+            trip = _get_item(trips, dir, date, key)
+            if not trip or str(trip.get('Chat ID')) != str(driver_id):
+                orphans['Offers'].append(f"/Drivers/{driver_id}/Offers/{dir}/{date}/{key}")
+
+    # Passengers' reserved trips
+    for user_id, reservations in passengers.items():
+        for dir, date, key in _iterate_index(reservations):
+            trip = _get_item(trips, dir, date, key)
+            if not trip or str(user_id) not in map(str, trip.get('Passengers', {})):
+                orphans['Passengers'].append(f"/Passengers/{user_id}/{dir}/{date}/{key}")
+
+    # Users' trip requests
+    for user_id, user in users.items():
+        if not isinstance(user, dict):
+            continue
+        for dir, date, key in _iterate_index(user.get('Requests')):
+            req = _get_item(requests, dir, date, key)
+            if not req or str(req.get('Chat ID')) != str(user_id):
+                orphans['Requests'].append(f"/Users/{user_id}/Requests/{dir}/{date}/{key}")
+
+    return orphans
+
+def repair_orphaned_index_entries(orphans):
+    """Deletes the given orphaned index entries, in batches of atomic updates.
+
+    Parameters
+    ----------
+    orphans : dict
+        Dictionary with the lists of orphaned paths, as returned by
+        `find_orphaned_index_entries`.
+
+    Returns
+    -------
+    int
+        Number of deleted entries.
+
+    """
+    paths = [path for index_type in orphans for path in orphans[index_type]]
+    for i in range(0, len(paths), REPAIR_BATCH_SIZE):
+        multi_path_update({path: None for path in paths[i:i+REPAIR_BATCH_SIZE]})
+    if paths:
+        logger.info(f"Deleted {len(paths)} orphaned index entries.")
+    return len(paths)
+
+def find_missing_passenger_entries():
+    """Looks for trip passengers without the trip in their own reservations
+    index. These can appear if the bot stops between the two writes of a
+    reservation, and they are neither shown to the passenger nor cancelled
+    along with the rest of their reservations.
+
+    Returns
+    -------
+    list(str)
+        Paths of the missing entries in the passengers' index.
+
+    """
+    # Reservations write the trip before the index entry, so the trips are
+    # read first. Otherwise, a reservation made in between would be missing
+    trips = get_backend().reference("/Trips").get() or dict()
+    passengers = get_backend().reference("/Passengers").get() or dict()
+    missing = []
+    for dir, date, key in _iterate_index(trips):
+        trip = _get_item(trips, dir, date, key)
+        if not isinstance(trip, dict):
+            continue
+        for user_id in trip.get('Passengers') or dict():
+            reservations = passengers.get(str(user_id))
+            if not isinstance(reservations, dict) or \
+                    not _get_item(reservations, dir, date, key):
+                missing.append(f"/Passengers/{user_id}/{dir}/{date}/{key}")
+    return missing
+
+def repair_missing_passenger_entries(missing):
+    """Adds the given missing entries to the passengers' index, in batches of
+    atomic updates.
+
+    Parameters
+    ----------
+    missing : list(str)
+        Paths of the missing entries, as returned by
+        `find_missing_passenger_entries`.
+
+    Returns
+    -------
+    int
+        Number of added entries.
+
+    """
+    paths = []
+    for path in missing:
+        _, _, user_id, dir, date, key = path.split('/')
+        # Skip the passengers who left the trip after the check
+        if get_backend().reference(f"/Trips/{dir}/{date}/{key}/Passengers/{user_id}").get():
+            paths.append(path)
+    for i in range(0, len(paths), REPAIR_BATCH_SIZE):
+        multi_path_update({path: True for path in paths[i:i+REPAIR_BATCH_SIZE]})
+    if paths:
+        logger.info(f"Added {len(paths)} missing passenger index entries.")
+    return len(paths)
+
+def check_index_consistency(repair=False):
+    """Checks the consistency of the drivers', passengers' and users' indexes
+    and, optionally, repairs them.
+
+    Parameters
+    ----------
+    repair : boolean
+        If True, orphaned index entries are deleted and missing ones are added.
+
+    Returns
+    -------
+    dict
+        Number of orphaned entries found, keyed by index type, in 'Orphaned',
+        and number of missing entries of the passengers' index in 'Missing'.
+
+    """
+    orphans = find_orphaned_index_entries()
+    missing = find_missing_passenger_entries()
+    if repair:
+        repair_orphaned_index_entries(orphans)
+        repair_missing_passenger_entries(missing)
+    return {'Orphaned': {index_type: len(orphans[index_type]) for index_type in orphans},
+            'Missing': {'Passengers': len(missing)}}
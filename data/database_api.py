@@ -1,13 +1,334 @@
-import firebase_admin
-from firebase_admin import db
-import json
+import json, random, threading
 from datetime import datetime
 from utils.common import week_isoformats, weekdays_en, dir_dict
 from collections import OrderedDict
+from enum import Enum
+from concurrent.futures import ThreadPoolExecutor
+from data.mirror import NodeMirror
+from data.week_mirror import WeekMirror
+from data.cache import TTLCache
+from data.request_scope import ScopedReference
+
+# Seconds that the registration and driver role of a user are cached
+MEMBERSHIP_CACHE_TTL = 600
+# Seconds that users' names are cached, and maximum number of cached names
+NAME_CACHE_TTL = 3600
+NAME_CACHE_SIZE = 2000
+# Maximum number of parallel reads when fetching several names at once
+NAME_FETCH_WORKERS = 8
+# Seconds that drivers' profiles are cached, and maximum number of cached profiles
+PROFILE_CACHE_TTL = 600
+PROFILE_CACHE_SIZE = 500
+
+# In-memory mirrors of frequently read nodes
+banned_mirror = NodeMirror("/Banned")
+# Inverted index (direction, weekday or 'All days', hour or 'All hours') -> chat IDs
+offer_notif_mirror = NodeMirror("/Notifications/Offers")
+# Users to whom messages can't be delivered, e.g. because they blocked the bot
+unreachable_mirror = NodeMirror("/Unreachable")
+# Index lowercased Telegram username (without '@') -> chat ID
+username_mirror = NodeMirror("/UsernameIndex")
+mirrors = [banned_mirror, offer_notif_mirror, unreachable_mirror, username_mirror]
+# In-memory copies of the trips and requests of the week ahead, which are the
+# ones users look at. Other dates are read from the database
+trips_mirror = WeekMirror("/Trips", dir_dict)
+requests_mirror = WeekMirror("/Requests", dir_dict)
+week_mirrors = [trips_mirror, requests_mirror]
+
+# Caches for the registration and driver role checks, keyed by chat ID string
+registered_cache = TTLCache(MEMBERSHIP_CACHE_TTL)
+driver_cache = TTLCache(MEMBERSHIP_CACHE_TTL)
+# Cache of the users' names, keyed by chat ID string
+name_cache = TTLCache(NAME_CACHE_TTL, NAME_CACHE_SIZE)
+# Cache of the drivers' scalar settings (slots, car, fee...), keyed by chat ID string
+profile_cache = TTLCache(PROFILE_CACHE_TTL, PROFILE_CACHE_SIZE)
+
+# Functions called with the list of deleted paths after each multi-path update
+deletion_listeners = []
+
+# Multi-path writes
+
+# Characters used by Firebase for push keys, in lexicographical order
+PUSH_CHARS = '-0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz'
+_push_key_lock = threading.Lock()
+_last_push_time = 0
+_last_rand_indexes = [0]*12
+
+def generate_push_key():
+    """Generates a unique chronologically-ordered key locally, with the same
+    format as the ones created by `push()`, so that the new node can be
+    written together with other paths in a single update.
+
+    Returns
+    -------
+    string
+        The 20-character key.
+
+    """
+    global _last_push_time, _last_rand_indexes
+    now = int(datetime.now().timestamp()*1000)
+    with _push_key_lock:
+        if now == _last_push_time:
+            # Same millisecond: increment the random part to keep the order
+            for i in range(11, -1, -1):
+                if _last_rand_indexes[i] < 63:
+                    _last_rand_indexes[i] += 1
+                    break
+                _last_rand_indexes[i] = 0
+        else:
+            _last_push_time = now
+            _last_rand_indexes = [random.randrange(64) for i in range(12)]
+        rand_indexes = list(_last_rand_indexes)
+
+    time_chars = []
+    for i in range(8):
+        time_chars.append(PUSH_CHARS[now % 64])
+        now //= 64
+    return ''.join(reversed(time_chars)) + ''.join(PUSH_CHARS[i] for i in rand_indexes)
+
+def multi_path_update(updates):
+    """Writes several locations of the database at once. The write is atomic:
+    either all of the locations are updated or none of them.
+    The functions in `deletion_listeners` are called afterwards with the
+    list of deleted paths.
+
+    Parameters
+    ----------
+    updates : dict
+        New values keyed by their absolute paths. None values delete the path.
+
+    Returns
+    -------
+    None
+
+    """
+    if not updates:
+        return
+    updates = {path.strip('/'): value for path, value in updates.items()}
+    # Firebase rejects updates containing a path and one of its ancestors, so
+    # drop the paths that are already being deleted through an ancestor
+    deleted = {path for path, value in updates.items() if value is None}
+    for path in list(updates):
+        segments = path.split('/')
+        if any('/'.join(segments[:i]) in deleted for i in range(1, len(segments))):
+            del updates[path]
+    ScopedReference('/').update(updates)
+    _update_mirrors(updates)
+    deleted = [f"/{path}" for path, value in updates.items() if value is None]
+    if deleted:
+        for listener in deletion_listeners:
+            listener(deleted)
+
+def _update_mirrors(updates):
+    """Applies a root-level multi-path update to the in-memory mirrors, so
+    they reflect the bot's own writes without waiting for the stream."""
+    for mirror in mirrors:
+        if mirror.is_loaded:
+            mirror.apply_update(updates)
+    for week_mirror in week_mirrors:
+        week_mirror.apply_update(updates)
+
+# Local reads
+
+def _local_get(path):
+    """Gets the value of a path from the week mirrors, if they cover it.
+
+    Parameters
+    ----------
+    path : string
+        Absolute database path.
+
+    Returns
+    -------
+    (boolean, object)
+        Whether the path is in memory, and a copy of its value.
+
+    """
+    for week_mirror in week_mirrors:
+        found, value = week_mirror.lookup(path)
+        if found:
+            return True, value
+    return False, None
+
+def _get(path):
+    """Reads a node from memory if possible, or from the database otherwise."""
+    found, value = _local_get(path)
+    if found:
+        return value
+    return ScopedReference(path).get()
+
+# Shallow reads
+
+def _exists(path):
+    """Checks whether a node exists without downloading its children.
+
+    Parameters
+    ----------
+    path : string
+        Database path of the node.
+
+    Returns
+    -------
+    boolean
+        True if the node exists, False otherwise.
+
+    """
+    found, value = _local_get(path)
+    if found:
+        return value != None
+    return ScopedReference(path).get(shallow=True) != None
+
+def _get_child_keys(path):
+    """Gets the keys of the children of a node without downloading them.
+
+    Parameters
+    ----------
+    path : string
+        Database path of the node.
+
+    Returns
+    -------
+    list(str)
+        Keys of the node's children. Empty if the node doesn't exist.
+
+    """
+    found, keys_dict = _local_get(path)
+    if not found:
+        keys_dict = ScopedReference(path).get(shallow=True)
+    if isinstance(keys_dict, dict):
+        return list(keys_dict)
+    else:
+        return list()
+
+# Bulk reads
+
+def _get_children_by_keys(path, keys):
+    """Gets several children of a node at once, with a single query over
+    the range of keys that contains all of them.
+
+    Parameters
+    ----------
+    path : string
+        Database path of the parent node.
+    keys : iterable of strings
+        Keys of the children to get.
+
+    Returns
+    -------
+    dict
+        Found children keyed by their keys. Keys that don't exist are omitted.
+
+    """
+    keys = sorted(keys)
+    if not keys:
+        return dict()
+    found, children = _local_get(path)
+    if found:
+        children = children or dict()
+    elif len(keys) == 1:
+        children = {keys[0]: ScopedReference(f"{path}/{keys[0]}").get()}
+    else:
+        query = ScopedReference(path).order_by_key()
+        children = query.start_at(keys[0]).end_at(keys[-1]).get()
+    if not children:
+        return dict()
+    return {key: children[key] for key in keys if children.get(key) != None}
+
+def _get_indexed_items(index_path, items_path, date_start=None, date_end=None):
+    """Gets the trips or requests referenced by a user's index node, which
+    has the format {direction: {date: {key: True}}}.
+    Only one query is done per direction and date, no matter how many items
+    there are in each date.
+
+    Parameters
+    ----------
+    index_path : string
+        Database path of the user's index, such as '/Drivers/<chat_id>/Offers'.
+    items_path : string
+        Database path where the items are stored, such as '/Trips'.
+    date_start : string
+        Range's start date with ISO format 'YYYY-mm-dd'. Optional
+    date_end : string
+        Range's stop date with ISO format 'YYYY-mm-dd'. Optional
+
+    Returns
+    -------
+    dict
+        Dictionary with format {direction: {date: {key: <item dict>}}}, with
+        each date's items ordered by time.
+
+    """
+    ref = ScopedReference(index_path)
+    items_dict = dict()
+    # Dates of the week ahead come already ordered from the time index
+    week_mirror = next((mirror for mirror in week_mirrors
+                                        if mirror.path == items_path), None)
+
+    for dir in list(dir_dict.keys()):
+        query = ref.child(dir).order_by_key()
+        if date_start:
+            query = query.start_at(date_start)
+        if date_end:
+            query = query.end_at(date_end)
+
+        keys_dict = query.get()
+        if keys_dict:
+            dir_items = dict()
+            for date in keys_dict:
+                found, date_items = week_mirror.get_range(dir, date,
+                                        keys=keys_dict[date]) if week_mirror \
+                                                            else (False, None)
+                if not found:
+                    date_items = _get_children_by_keys(f"{items_path}/{dir}/{date}",
+                                                        keys_dict[date])
+                    date_items = OrderedDict(
+                            sorted(date_items.items(), key=lambda x: x[1]['Time']))
+                if date_items:
+                    dir_items[date] = date_items
+            if dir_items:
+                items_dict[dir] = dir_items
+
+    return items_dict
+
+def _order_items_by_date(items_dict):
+    """Regroups a {direction: {date: {key: item}}} dictionary of trips or
+    requests by date, saving the direction of each item in a 'Direction' field.
+
+    Parameters
+    ----------
+    items_dict : dict
+        Dictionary with format {direction: {date: {key: <item dict>}}}.
+
+    Returns
+    -------
+    dict
+        Dictionary with format {date: {key: <item dict>}}, ordered by date
+        and with each date's items ordered by time.
+
+    """
+    items_dict_by_date = dict()
+    dates = set()
+    # First narrow down the dates to process
+    for dir in items_dict:
+        dates = dates.union(set(items_dict[dir]))
+    # We want to present the items by date
+    for date in sorted(dates):
+        date_items = dict()
+        for dir in items_dict:
+            if date in items_dict[dir]:
+                # Save the direction of each item in an specific field
+                for key in items_dict[dir][date]:
+                    items_dict[dir][date][key]['Direction'] = dir
+                date_items.update(items_dict[dir][date])
+        # Order dict by time if it exists
+        if date_items:
+            items_dict_by_date[date] = OrderedDict(
+                    sorted(date_items.items(), key=lambda x: x[1]['Time']))
+    return items_dict_by_date
 
 # General
 
-def add_user(chat_id, username):
+def add_user(chat_id, username, tg_username=None):
     """Adds a new user to the database given its chat_id.
 
     Parameters
@@ -16,14 +337,23 @@ def add_user(chat_id, username):
         The chat_id of the user.
     username : str
         The given username.
+    tg_username : str
+        Optional. The Telegram username of the user.
 
     Returns
     -------
     None
 
     """
-    ref = db.reference(f"/Users/{str(chat_id)}")
-    ref.set({"Name": username})
+    user_dict = {"Name": username}
+    updates = {f"/Users/{str(chat_id)}": user_dict}
+    if tg_username:
+        tg_username = _prefix_tg_username(tg_username)
+        user_dict['Username'] = tg_username
+        updates[f"/UsernameIndex/{_username_key(tg_username)}"] = str(chat_id)
+    multi_path_update(updates)
+    registered_cache.set(str(chat_id), True)
+    name_cache.set(str(chat_id), username)
 
 def get_all_chat_ids():
     """Gets a list with all registered users' chat IDs
@@ -34,11 +364,7 @@ def get_all_chat_ids():
         List with registered chat IDs.
 
     """
-    users_dict = db.reference("/Users").get()
-    if users_dict:
-        return list(users_dict)
-    else:
-        return list()
+    return _get_child_keys("/Users")
 
 def is_registered(chat_id):
     """Checks whether a user is already registered in the database.
@@ -54,8 +380,9 @@ def is_registered(chat_id):
         True if it is already registered, False otherwise.
 
     """
-    ref = db.reference('/Users')
-    return ref.child(str(chat_id)).get() != None
+    def load(id):
+        return _exists(f"/Users/{id}")
+    return registered_cache.get(str(chat_id), load)
 
 def get_name(chat_id):
     """Gets the username given its chat_id.
@@ -71,8 +398,35 @@ def get_name(chat_id):
         The username.
 
     """
+    return name_cache.get(str(chat_id), _load_name)
+
+def _load_name(chat_id):
+    """Reads a user's name from the database."""
+    return ScopedReference(f"/Users/{chat_id}/Name").get()
+
+def get_names(chat_ids):
+    """Gets the usernames of several users at once. The names that are not
+    cached are read in parallel.
 
-    return db.reference(f"/Users/{str(chat_id)}/Name").get()
+    Parameters
+    ----------
+    chat_ids : list
+        List of chat IDs.
+
+    Returns
+    -------
+    dict
+        Usernames keyed by chat ID strings. Users that don't exist are omitted.
+
+    """
+    chat_ids = set(str(id) for id in chat_ids)
+    missing = [id for id in chat_ids if id not in name_cache]
+    if len(missing) > 1:
+        with ThreadPoolExecutor(min(NAME_FETCH_WORKERS, len(missing))) as executor:
+            for id, name in zip(missing, executor.map(_load_name, missing)):
+                name_cache.set(id, name)
+    names = {id: name_cache.get(id, _load_name) for id in chat_ids}
+    return {id: name for id, name in names.items() if name}
 
 def set_name(chat_id, name):
     """Sets the username given its chat_id.
@@ -90,8 +444,9 @@ def set_name(chat_id, name):
 
     """
 
-    ref = db.reference(f"/Users/{str(chat_id)}")
+    ref = ScopedReference(f"/Users/{str(chat_id)}")
     ref.update({'Name': name})
+    name_cache.set(str(chat_id), name)
 
 def get_tg_username(chat_id):
     """Gets the Telegram username given its chat_id.
@@ -108,10 +463,19 @@ def get_tg_username(chat_id):
 
     """
 
-    return db.reference(f"/Users/{str(chat_id)}/Username").get()
+    return ScopedReference(f"/Users/{str(chat_id)}/Username").get()
+
+def _prefix_tg_username(username):
+    """Adds the '@' at the beginning of a Telegram username if missing."""
+    return username if username[0]=='@' else f"@{username}"
+
+def _username_key(username):
+    """Obtains the key of a Telegram username in the usernames index."""
+    return username.lstrip('@').lower()
 
 def set_tg_username(chat_id, username):
-    """Sets the Telegram username given its chat_id.
+    """Sets the Telegram username given its chat_id, updating the usernames
+    index at once.
 
     Parameters
     ----------
@@ -125,10 +489,38 @@ def set_tg_username(chat_id, username):
     None
 
     """
-    if username[0]!='@':
-        username = f"@{username}"
-    ref = db.reference(f"/Users/{str(chat_id)}")
-    ref.update({'Username': username})
+    username = _prefix_tg_username(username)
+    updates = {f"/Users/{str(chat_id)}/Username": username,
+               f"/UsernameIndex/{_username_key(username)}": str(chat_id)}
+    old_username = get_tg_username(chat_id)
+    if old_username and _username_key(old_username) != _username_key(username) \
+            and get_chat_id_from_tg_username(old_username) == str(chat_id):
+        updates[f"/UsernameIndex/{_username_key(old_username)}"] = None
+    multi_path_update(updates)
+
+def refresh_tg_username(chat_id, username):
+    """Updates the Telegram username of a registered user if it has changed,
+    comparing it with the in-memory usernames index, so nothing is read or
+    written while it stays the same.
+
+    Parameters
+    ----------
+    chat_id : int or string
+        The chat_id of the user.
+    username : string
+        The Telegram username seen in the user's last update. Can be None.
+
+    Returns
+    -------
+    None
+
+    """
+    if not username or not username_mirror.is_loaded:
+        return
+    if username_mirror.get(_username_key(username)) == str(chat_id):
+        return
+    if is_registered(chat_id):
+        set_tg_username(chat_id, username)
 
 def get_chat_id_from_tg_username(username):
     """Gets the chat_id from the given Telegram username.
@@ -145,14 +537,29 @@ def get_chat_id_from_tg_username(username):
         in the database, an empty string otherwise.
 
     """
-    if username[0]!='@':
-        username = f"@{username}"
-    user_dict = db.reference("/Users").order_by_child('Username').equal_to(username).get()
-    if user_dict:
-        for user_id in user_dict:
-            return user_id
+    key = _username_key(username)
+    if username_mirror.is_loaded:
+        user_id = username_mirror.get(key)
     else:
-        return ''
+        user_id = ScopedReference(f"/UsernameIndex/{key}").get()
+    return str(user_id) if user_id else ''
+
+def backfill_username_index():
+    """Rebuilds the usernames index from the users' Telegram usernames. Only
+    needed once, for the users registered before the index existed.
+
+    Returns
+    -------
+    int
+        Number of indexed usernames.
+
+    """
+    users_dict = ScopedReference("/Users").get() or dict()
+    index = {_username_key(user['Username']): str(chat_id)
+             for chat_id, user in users_dict.items()
+             if isinstance(user, dict) and user.get('Username')}
+    multi_path_update({"/UsernameIndex": index or None})
+    return len(index)
 
 def delete_user(chat_id):
     """Deletes user from database.
@@ -179,8 +586,14 @@ def delete_user(chat_id):
     # Delete possible driver-related things
     if is_driver(chat_id):
         delete_driver(chat_id)
-    # Finally, completely delete user
-    db.reference(f"/Users/{str(chat_id)}").delete()
+    # Finally, completely delete user and its username from the index
+    updates = {f"/Users/{str(chat_id)}": None}
+    tg_username = get_tg_username(chat_id)
+    if tg_username and get_chat_id_from_tg_username(tg_username) == str(chat_id):
+        updates[f"/UsernameIndex/{_username_key(tg_username)}"] = None
+    multi_path_update(updates)
+    registered_cache.set(str(chat_id), False)
+    name_cache.invalidate(str(chat_id))
 
 def ban_user(chat_id):
     """Bans user from bot.
@@ -199,7 +612,8 @@ def ban_user(chat_id):
     if is_registered(chat_id):
         delete_user(chat_id)
     # Put user ID in banned list
-    db.reference(f"/Banned/{str(chat_id)}").set(True)
+    ScopedReference(f"/Banned/{str(chat_id)}").set(True)
+    banned_mirror.put(str(chat_id), True)
 
 def is_banned(chat_id):
     """Checks whether user is banned from bot.
@@ -215,7 +629,9 @@ def is_banned(chat_id):
         True if it is banned, False otherwise.
 
     """
-    return True if db.reference(f"/Banned/{str(chat_id)}").get()==True else False
+    if banned_mirror.is_loaded:
+        return banned_mirror.get(str(chat_id)) == True
+    return True if ScopedReference(f"/Banned/{str(chat_id)}").get()==True else False
 
 def unban_user(chat_id):
     """Unbans user from bot.
@@ -231,7 +647,141 @@ def unban_user(chat_id):
 
     """
     if is_banned(chat_id):
-        db.reference(f"/Banned/{str(chat_id)}").delete()
+        ScopedReference(f"/Banned/{str(chat_id)}").delete()
+        banned_mirror.put(str(chat_id), None)
+
+def set_unreachable(chat_id):
+    """Records that messages can't be delivered to a user, for example
+    because they have blocked the bot.
+
+    Parameters
+    ----------
+    chat_id : int or string
+        The chat_id of the unreachable user.
+
+    Returns
+    -------
+    None
+
+    """
+    ScopedReference(f"/Unreachable/{str(chat_id)}").set(True)
+    unreachable_mirror.put(str(chat_id), True)
+
+def is_unreachable(chat_id):
+    """Checks whether messages can't be delivered to a user.
+
+    Parameters
+    ----------
+    chat_id : int or string
+        The chat_id to check.
+
+    Returns
+    -------
+    Boolean
+        True if it is unreachable, False otherwise.
+
+    """
+    if unreachable_mirror.is_loaded:
+        return unreachable_mirror.get(str(chat_id)) == True
+    return _exists(f"/Unreachable/{str(chat_id)}")
+
+def set_reachable(chat_id):
+    """Removes a user from the unreachable users list.
+
+    Parameters
+    ----------
+    chat_id : int or string
+        The chat_id of the user.
+
+    Returns
+    -------
+    None
+
+    """
+    if is_unreachable(chat_id):
+        ScopedReference(f"/Unreachable/{str(chat_id)}").delete()
+        unreachable_mirror.put(str(chat_id), None)
+
+def filter_reachable(chat_ids):
+    """Removes the unreachable users from a list of chat IDs.
+
+    Parameters
+    ----------
+    chat_ids : list
+        List of chat IDs.
+
+    Returns
+    -------
+    list
+        The chat IDs of the list that are not unreachable.
+
+    """
+    if unreachable_mirror.is_loaded:
+        unreachable = unreachable_mirror.get() or dict()
+    else:
+        unreachable = set(_get_child_keys("/Unreachable"))
+    return [id for id in chat_ids if str(id) not in unreachable]
+
+def load_mirrors(stream=True):
+    """Loads into memory the database nodes which are read most often, such
+    as the banned users list or the offers' notifications index.
+
+    Parameters
+    ----------
+    stream : boolean
+        If True, stream listeners keep the local copies up to date. Otherwise,
+        `refresh_mirrors` must be called periodically.
+
+    Returns
+    -------
+    None
+
+    """
+    for mirror in mirrors:
+        mirror.start(stream)
+    for week_mirror in week_mirrors:
+        week_mirror.start(week_isoformats(), stream)
+
+def refresh_mirrors():
+    """Reloads the in-memory copies of the database nodes.
+
+    Returns
+    -------
+    None
+
+    """
+    for mirror in mirrors:
+        mirror.refresh()
+    for week_mirror in week_mirrors:
+        week_mirror.refresh()
+
+def roll_week_mirrors():
+    """Moves the in-memory copies of the trips and requests to the week
+    ahead. Must be called when the day changes.
+
+    Returns
+    -------
+    None
+
+    """
+    for week_mirror in week_mirrors:
+        week_mirror.roll(week_isoformats())
+
+def get_cache_stats():
+    """Gets the size and hit/miss counters of the in-memory caches.
+
+    Returns
+    -------
+    dict
+        Dictionary with the statistics of each cache, keyed by cache name.
+
+    """
+    return {'Registered': registered_cache.stats(),
+            'Drivers': driver_cache.stats(),
+            'Names': name_cache.stats(),
+            'Profiles': profile_cache.stats(),
+            'Week trips': trips_mirror.stats(),
+            'Week requests': requests_mirror.stats()}
 
 
 # Drivers
@@ -254,9 +804,11 @@ def add_driver(chat_id, slots, car):
 
     """
 
-    ref = db.reference(f"/Drivers/{str(chat_id)}")
+    ref = ScopedReference(f"/Drivers/{str(chat_id)}")
     ref.set({"Slots": slots})
     ref.update({"Car": car})
+    driver_cache.set(str(chat_id), True)
+    profile_cache.invalidate(str(chat_id))
 
 def is_driver(chat_id):
     """Checks whether the user given by chat_id is a driver.
@@ -273,8 +825,9 @@ def is_driver(chat_id):
 
     """
 
-    ref = db.reference('/Drivers')
-    return ref.child(str(chat_id)).get() != None
+    def load(id):
+        return _exists(f"/Drivers/{id}")
+    return driver_cache.get(str(chat_id), load)
 
 def delete_driver(chat_id):
     """Deletes user from the drivers list.
@@ -297,7 +850,36 @@ def delete_driver(chat_id):
     # Delete published trips
     delete_all_trips_by_driver(chat_id)
     # Finally, delete driver
-    db.reference(f"/Drivers/{str(chat_id)}").delete()
+    ScopedReference(f"/Drivers/{str(chat_id)}").delete()
+    driver_cache.set(str(chat_id), False)
+    profile_cache.invalidate(str(chat_id))
+
+def get_driver_profile(chat_id):
+    """Gets the scalar settings of a driver (slots, car, fee, Bizum, phone,
+    home and university), without their offered trips or notifications.
+    They are read at once and cached.
+
+    Parameters
+    ----------
+    chat_id : int or string
+        The chat_id to check.
+
+    Returns
+    -------
+    dict
+        Driver's settings keyed by their names. Empty if it is not a driver.
+
+    """
+    return profile_cache.get(str(chat_id), _load_driver_profile)
+
+def _load_driver_profile(chat_id):
+    """Reads a driver's scalar settings from the database."""
+    # A shallow read returns the scalar values and only truncates the children
+    profile = ScopedReference(f"/Drivers/{chat_id}").get(shallow=True)
+    if not isinstance(profile, dict):
+        return dict()
+    return {key: value for key, value in profile.items()
+                    if key not in ('Offers', 'Request Notifications')}
 
 def get_slots(chat_id):
     """Gets the number of slots of a driver.
@@ -314,8 +896,7 @@ def get_slots(chat_id):
 
     """
 
-    ref = db.reference(f"/Drivers/{str(chat_id)}")
-    return int(ref.child('Slots').get())
+    return int(get_driver_profile(chat_id).get('Slots'))
 
 def set_slots(chat_id, slots):
     """Sets the number of slots of a driver.
@@ -333,7 +914,8 @@ def set_slots(chat_id, slots):
 
     """
 
-    db.reference(f"/Drivers/{str(chat_id)}").update({"Slots": slots})
+    ScopedReference(f"/Drivers/{str(chat_id)}").update({"Slots": slots})
+    profile_cache.invalidate(str(chat_id))
 
 def get_car(chat_id):
     """Gets the car description of a driver.
@@ -350,8 +932,7 @@ def get_car(chat_id):
 
     """
 
-    ref = db.reference(f"/Drivers/{str(chat_id)}")
-    return ref.child('Car').get()
+    return get_driver_profile(chat_id).get('Car')
 
 def set_car(chat_id, car):
     """Sets the car description of a driver.
@@ -369,7 +950,8 @@ def set_car(chat_id, car):
 
     """
 
-    db.reference(f"/Drivers/{str(chat_id)}").update({"Car": car})
+    ScopedReference(f"/Drivers/{str(chat_id)}").update({"Car": car})
+    profile_cache.invalidate(str(chat_id))
 
 def get_fee(chat_id):
     """Gets the per-user payment quantity for a driver.
@@ -386,8 +968,7 @@ def get_fee(chat_id):
 
     """
 
-    ref = db.reference(f"/Drivers/{str(chat_id)}")
-    fee = ref.child('Fee').get()
+    fee = get_driver_profile(chat_id).get('Fee')
     if fee != None:
         return float(fee)
     else:
@@ -409,7 +990,8 @@ def set_fee(chat_id, fee):
 
     """
 
-    db.reference(f"/Drivers/{str(chat_id)}").update({"Fee": fee})
+    ScopedReference(f"/Drivers/{str(chat_id)}").update({"Fee": fee})
+    profile_cache.invalidate(str(chat_id))
 
 def get_bizum(chat_id):
     """Gets the Bizum preference a driver.
@@ -426,8 +1008,7 @@ def get_bizum(chat_id):
 
     """
 
-    ref = db.reference(f"/Drivers/{str(chat_id)}")
-    bizum = ref.child('Bizum').get()
+    bizum = get_driver_profile(chat_id).get('Bizum')
     if bizum == 'Yes':
         return True
     elif bizum == 'No':
@@ -451,11 +1032,12 @@ def set_bizum(chat_id, bizum_pref):
 
     """
 
-    ref = db.reference(f"/Drivers/{str(chat_id)}")
+    ref = ScopedReference(f"/Drivers/{str(chat_id)}")
     if bizum_pref:
         ref.update({"Bizum": "Yes"})
     else:
         ref.update({"Bizum": "No"})
+    profile_cache.invalidate(str(chat_id))
 
 def get_phone(chat_id):
     """Gets the phone number of a driver.
@@ -472,8 +1054,7 @@ def get_phone(chat_id):
 
     """
 
-    ref = db.reference(f"/Drivers/{str(chat_id)}")
-    return ref.child('Phone').get()
+    return get_driver_profile(chat_id).get('Phone')
 
 def set_phone(chat_id, phone):
     """Sets the phone number of a driver.
@@ -490,11 +1071,12 @@ def set_phone(chat_id, phone):
     None
 
     """
-    ref = db.reference(f"/Drivers/{str(chat_id)}/Phone")
+    ref = ScopedReference(f"/Drivers/{str(chat_id)}/Phone")
     if phone:
         ref.set(phone)
     else:
         ref.delete()
+    profile_cache.invalidate(str(chat_id))
 
 def get_home(chat_id):
     """Gets the description of the location from where the driver usually
@@ -512,8 +1094,7 @@ def get_home(chat_id):
 
     """
 
-    ref = db.reference(f"/Drivers/{str(chat_id)}")
-    return ref.child('Home').get()
+    return get_driver_profile(chat_id).get('Home')
 
 def set_home(chat_id, home=None):
     """Sets the description of the location from where the driver usually
@@ -531,11 +1112,12 @@ def set_home(chat_id, home=None):
     None
 
     """
-    ref = db.reference(f"/Drivers/{str(chat_id)}/Home")
+    ref = ScopedReference(f"/Drivers/{str(chat_id)}/Home")
     if home:
         ref.set(home)
     else:
         ref.delete()
+    profile_cache.invalidate(str(chat_id))
 
 def get_univ(chat_id):
     """Gets the description of the location to where the driver usually
@@ -553,8 +1135,7 @@ def get_univ(chat_id):
 
     """
 
-    ref = db.reference(f"/Drivers/{str(chat_id)}")
-    return ref.child('Univ').get()
+    return get_driver_profile(chat_id).get('Univ')
 
 def set_univ(chat_id, univ=None):
     """Sets the description of the location to where the driver usually
@@ -572,11 +1153,12 @@ def set_univ(chat_id, univ=None):
     None
 
     """
-    ref = db.reference(f"/Drivers/{str(chat_id)}/Univ")
+    ref = ScopedReference(f"/Drivers/{str(chat_id)}/Univ")
     if univ:
         ref.set(univ)
     else:
         ref.delete()
+    profile_cache.invalidate(str(chat_id))
 
 # Trips
 
@@ -609,10 +1191,6 @@ def add_trip(direction, chat_id, date, time, slots=None, fee=None,
         Key of the newly created DB reference.
 
     """
-    ref = db.reference(f"/Trips/{direction}")
-    # date_string = departure_date.strftime('%Y-%m-%d')
-    ref = ref.child(date)
-
     # time_string = departure_date.strftime('%H:%M')
     trip_dict = {'Chat ID': chat_id,
                  'Time': time}
@@ -629,11 +1207,11 @@ def add_trip(direction, chat_id, date, time, slots=None, fee=None,
     if dest != None:
         trip_dict['Dest'] = dest
 
-    key = ref.push(trip_dict).key
+    key = generate_push_key()
 
-    # Now add the key to the driver's offers section
-    ref = db.reference(f"/Drivers/{chat_id}/Offers/{direction}/{date}/{key}")
-    ref.set(True)
+    # Write the trip and its key in the driver's offers section at once
+    multi_path_update({f"/Trips/{direction}/{date}/{key}": trip_dict,
+                       f"/Drivers/{chat_id}/Offers/{direction}/{date}/{key}": True})
 
     return key
 
@@ -654,13 +1232,36 @@ def delete_trip(direction, date, key):
     None
 
     """
-    chat_id = get_trip_chat_id(direction, date, key)
-    db.reference(f"/Trips/{direction}/{date}/{key}").delete()
-    db.reference(f"/Drivers/{chat_id}/Offers/{direction}/{date}/{key}").delete()
+    trip_dict = get_trip(direction, date, key)
+    if trip_dict:
+        multi_path_update(_trip_deletion_paths(direction, date, key, trip_dict))
 
-    # Remove passengers if any
-    for passenger_id in get_trip_passengers(direction, date, key):
-        remove_passenger(passenger_id, direction, date, key)
+def _trip_deletion_paths(direction, date, key, trip_dict):
+    """Obtains the paths to delete in order to remove a trip, its key in the
+    driver's offers section and its passengers' reservations.
+
+    Parameters
+    ----------
+    direction : string
+        Direction of the trip. Can be 'toBenalmadena' or 'toUMA'.
+    date : string
+        Departure date with ISO format 'YYYY-mm-dd'.
+    key : string
+        Unique key identifying the trip.
+    trip_dict : dict
+        Trip information.
+
+    Returns
+    -------
+    dict
+        Dictionary with the paths to delete as keys and None as values.
+
+    """
+    paths = {f"/Trips/{direction}/{date}/{key}": None,
+             f"/Drivers/{trip_dict['Chat ID']}/Offers/{direction}/{date}/{key}": None}
+    for passenger_id in trip_dict.get('Passengers', {}):
+        paths[f"/Passengers/{passenger_id}/{direction}/{date}/{key}"] = None
+    return paths
 
 def get_trip(direction, date, key):
     """Gets a dictionary with the given trip info.
@@ -680,60 +1281,47 @@ def get_trip(direction, date, key):
         Trip information.
 
     """
-    ref = db.reference(f"/Trips/{direction}/{date}/{key}")
-    return ref.get()
+    return _get(f"/Trips/{direction}/{date}/{key}")
 
 def get_trip_time(direction, date, key):
-    ref = db.reference(f"/Trips/{direction}/{date}/{key}")
-    return ref.child('Time').get()
+    return _get(f"/Trips/{direction}/{date}/{key}/Time")
 
 def get_trip_chat_id(direction, date, key):
-    ref = db.reference(f"/Trips/{direction}/{date}/{key}")
-    return ref.child('Chat ID').get()
+    return _get(f"/Trips/{direction}/{date}/{key}/Chat ID")
 
 def get_trip_slots(direction, date, key):
-    ref = db.reference(f"/Trips/{direction}/{date}/{key}")
-    return ref.child('Slots').get()
-
-def set_trip_slots(direction, date, key, slots=None):
-    ref = db.reference(f"/Trips/{direction}/{date}/{key}/Slots")
-    if slots:
-        ref.set(slots)
+    return _get(f"/Trips/{direction}/{date}/{key}/Slots")
+
+def _set_trip_field(direction, date, key, field, value=None):
+    """Sets a field of a trip, deleting it if value is empty."""
+    path = f"/Trips/{direction}/{date}/{key}/{field}"
+    ref = ScopedReference(path)
+    if value:
+        ref.set(value)
     else:
         ref.delete()
+    _update_mirrors({path: value or None})
+
+def set_trip_slots(direction, date, key, slots=None):
+    _set_trip_field(direction, date, key, 'Slots', slots)
 
 def get_trip_fee(direction, date, key):
-    ref = db.reference(f"/Trips/{direction}/{date}/{key}")
-    return ref.child('Fee').get()
+    return _get(f"/Trips/{direction}/{date}/{key}/Fee")
 
 def set_trip_fee(direction, date, key, fee=None):
-    ref = db.reference(f"/Trips/{direction}/{date}/{key}/Fee")
-    if fee:
-        ref.set(fee)
-    else:
-        ref.delete()
+    _set_trip_field(direction, date, key, 'Fee', fee)
 
 def get_trip_origin(direction, date, key):
-    ref = db.reference(f"/Trips/{direction}/{date}/{key}")
-    return ref.child('Origin').get()
+    return _get(f"/Trips/{direction}/{date}/{key}/Origin")
 
 def set_trip_origin(direction, date, key, origin=None):
-    ref = db.reference(f"/Trips/{direction}/{date}/{key}/Origin")
-    if origin:
-        ref.set(origin)
-    else:
-        ref.delete()
+    _set_trip_field(direction, date, key, 'Origin', origin)
 
 def get_trip_destination(direction, date, key):
-    ref = db.reference(f"/Trips/{direction}/{date}/{key}")
-    return ref.child('Dest').get()
+    return _get(f"/Trips/{direction}/{date}/{key}/Dest")
 
 def set_trip_destination(direction, date, key, dest=None):
-    ref = db.reference(f"/Trips/{direction}/{date}/{key}/Dest")
-    if dest:
-        ref.set(dest)
-    else:
-        ref.delete()
+    _set_trip_field(direction, date, key, 'Dest', dest)
 
 def get_trips_by_date_range(direction, date, time_start=None, time_end=None):
     """Gets a dictionary with the offered trips for a given date and,
@@ -759,7 +1347,11 @@ def get_trips_by_date_range(direction, date, time_start=None, time_end=None):
          ...}
 
     """
-    ref = db.reference(f"/Trips/{direction}/{date}/")
+    found, date_dict = trips_mirror.get_range(direction, date, time_start, time_end)
+    if found:
+        return date_dict
+
+    ref = ScopedReference(f"/Trips/{direction}/{date}/")
     query = ref.order_by_child("Time")
 
     if time_start:
@@ -791,50 +1383,12 @@ def get_trips_by_driver(chat_id, date_start=None, date_end=None, order_by_date=F
         Dictionary with the planned trips.
 
     """
-    ref = db.reference(f"/Drivers/{chat_id}/Offers")
-    trips_dict = dict()
-
-    for dir in list(dir_dict.keys()):
-        query = ref.child(dir).order_by_key()
-        if date_start:
-            query = query.start_at(date_start)
-        if date_end:
-            query = query.end_at(date_end)
-
-        trip_keys_dict = query.get()
-        if trip_keys_dict:
-            dir_trips = dict()
-            for date in trip_keys_dict:
-                date_trips = dict()
-                for key in trip_keys_dict[date]:
-                    date_trips[key] = get_trip(dir, date, key)
-                if date_trips:
-                    dir_trips[date] = OrderedDict(
-                            sorted(date_trips.items(), key=lambda x: x[1]['Time']))
-            if dir_trips:
-                trips_dict[dir] = dir_trips
+    trips_dict = _get_indexed_items(f"/Drivers/{chat_id}/Offers", "/Trips",
+                                    date_start, date_end)
 
     if trips_dict:
         if order_by_date:
-            trips_dict_by_date = dict()
-            dates = set()
-            # First narrow down the dates to process
-            for dir in trips_dict:
-                dates = dates.union(set(trips_dict[dir]))
-            # We want to present the trips by date
-            for date in sorted(dates):
-                date_trips = dict()
-                for dir in trips_dict:
-                    if date in trips_dict[dir]:
-                        # Save the direction of each trip in an specific field
-                        for key in trips_dict[dir][date]:
-                            trips_dict[dir][date][key]['Direction'] = dir
-                        date_trips.update(trips_dict[dir][date])
-                # Order dict by time if it exists
-                if date_trips:
-                    trips_dict_by_date[date] = OrderedDict(
-                            sorted(date_trips.items(), key=lambda x: x[1]['Time']))
-            return trips_dict_by_date
+            return _order_items_by_date(trips_dict)
         return trips_dict
     return
 
@@ -881,49 +1435,12 @@ def get_trips_by_passenger(chat_id, date_start=None, date_end=None, order_by_dat
         Dictionary with the reserved trips.
 
     """
-    ref = db.reference(f"/Passengers/{chat_id}")
-    trips_dict = dict()
-
-    for dir in list(dir_dict.keys()):
-        query = ref.child(dir).order_by_key()
-        if date_start:
-            query = query.start_at(date_start)
-        if date_end:
-            query = query.end_at(date_end)
-
-        trip_keys_dict = query.get()
-        if trip_keys_dict:
-            dir_trips = dict()
-            for date in trip_keys_dict:
-                date_trips = dict()
-                for key in trip_keys_dict[date]:
-                    date_trips[key] = get_trip(dir, date, key)
-                if date_trips:
-                    dir_trips[date] = OrderedDict(sorted(date_trips.items(), key=lambda x: x[1]['Time']))
-            if dir_trips:
-                trips_dict[dir] = dir_trips
+    trips_dict = _get_indexed_items(f"/Passengers/{chat_id}", "/Trips",
+                                    date_start, date_end)
 
     if trips_dict:
         if order_by_date:
-            trips_dict_by_date = dict()
-            dates = set()
-            # First narrow down the dates to process
-            for dir in trips_dict:
-                dates = dates.union(set(trips_dict[dir]))
-            # We want to present the trips by date
-            for date in sorted(dates):
-                date_trips = dict()
-                for dir in trips_dict:
-                    if date in trips_dict[dir]:
-                        # Save the direction of each trip in an specific field
-                        for key in trips_dict[dir][date]:
-                            trips_dict[dir][date][key]['Direction'] = dir
-                        date_trips.update(trips_dict[dir][date])
-                # Order dict by time if it exists
-                if date_trips:
-                    trips_dict_by_date[date] = OrderedDict(
-                            sorted(date_trips.items(), key=lambda x: x[1]['Time']))
-            return trips_dict_by_date
+            return _order_items_by_date(trips_dict)
         return trips_dict
     return
 
@@ -940,16 +1457,34 @@ def delete_all_trips_by_driver(chat_id):
     None
 
     """
-    ref = db.reference(f"/Drivers/{chat_id}/Offers")
-    trips_dict = ref.get()
-    if trips_dict:
-        for dir in trips_dict:
-            for date in trips_dict[dir]:
-                for trip_key in trips_dict[dir][date]:
-                    delete_trip(dir, date, trip_key)
-
-def add_passenger(chat_id, direction, date, key):
-    """Add passenger given by chat_id to the specified trip.
+    trips_dict = _get_indexed_items(f"/Drivers/{chat_id}/Offers", "/Trips")
+    paths = dict()
+    for dir in trips_dict:
+        for date in trips_dict[dir]:
+            for trip_key in trips_dict[dir][date]:
+                paths.update(_trip_deletion_paths(dir, date, trip_key,
+                                                  trips_dict[dir][date][trip_key]))
+    # Also remove index entries whose trips don't exist anymore
+    paths[f"/Drivers/{chat_id}/Offers"] = None
+    multi_path_update(paths)
+
+class BookingResult(Enum):
+    """Possible outcomes of a seat reservation."""
+    OK = 'ok'
+    FULL = 'full'
+    ALREADY_PASSENGER = 'already passenger'
+    TRIP_GONE = 'trip gone'
+
+class _BookingAborted(Exception):
+    """Raised inside a reservation transaction to abort it without writing."""
+    def __init__(self, result):
+        self.result = result
+
+def reserve_seat(chat_id, direction, date, key):
+    """Adds a passenger to a trip only if it still exists, the user is not
+    already a passenger and there are free seats. The check and the insertion
+    are done in a database transaction, so concurrent reservations can't
+    overbook the trip.
 
     Parameters
     ----------
@@ -964,24 +1499,43 @@ def add_passenger(chat_id, direction, date, key):
 
     Returns
     -------
-    Boolean
-        True if the user was added correctly.
+    BookingResult
+        OK if the user was added, or the reason why it was not.
 
     """
-    ref = db.reference(f"/Trips/{direction}/{date}/{key}/Passengers")
-    passengers_dict = ref.get()
-
-    if passengers_dict:
-        ref.update({chat_id: True})
-    else:
-        passengers_dict = {chat_id: True}
-        ref.set(passengers_dict)
-
-    # Now add it to the passenger's own list of reserved trips
-    ref = db.reference(f"/Passengers/{chat_id}/{direction}/{date}/{key}")
-    ref.set(True)
-
-    return True
+    driver_slots = dict()
+
+    def transaction_update(trip_dict):
+        if not trip_dict:
+            raise _BookingAborted(BookingResult.TRIP_GONE)
+        passengers = trip_dict.get('Passengers') or dict()
+        if str(chat_id) in map(str, passengers):
+            raise _BookingAborted(BookingResult.ALREADY_PASSENGER)
+        slots = trip_dict.get('Slots')
+        if slots == None:
+            # The driver's default seats are only read once, even on retries
+            driver_id = trip_dict['Chat ID']
+            if driver_id not in driver_slots:
+                driver_slots[driver_id] = get_slots(driver_id)
+            slots = driver_slots[driver_id]
+        if len(passengers) >= int(slots):
+            raise _BookingAborted(BookingResult.FULL)
+        passengers[str(chat_id)] = True
+        trip_dict['Passengers'] = passengers
+        return trip_dict
+
+    path = f"/Trips/{direction}/{date}/{key}"
+    try:
+        trip_dict = ScopedReference(path).transaction(transaction_update)
+    except _BookingAborted as e:
+        return e.result
+    _update_mirrors({path: trip_dict})
+
+    # Now add it to the passenger's own list of reserved trips. If this write
+    # fails or the bot stops before it, /checkdb fix adds the missing entry
+    ScopedReference(f"/Passengers/{chat_id}/{direction}/{date}/{key}").set(True)
+
+    return BookingResult.OK
 
 def is_passenger(chat_id, direction, date, key):
     """Checks whether user is already a passenger in the trip.
@@ -1003,11 +1557,7 @@ def is_passenger(chat_id, direction, date, key):
         True if user is passenger already, False otherwise.
 
     """
-    ref = db.reference(f"/Passengers/{chat_id}/{direction}/{date}/{key}")
-    if ref.get():
-        return True
-    else:
-        return False
+    return _exists(f"/Passengers/{chat_id}/{direction}/{date}/{key}")
 
 def get_trip_passengers(direction, date, key):
     """Returns the list of confirmed passengers in a trip.
@@ -1027,12 +1577,7 @@ def get_trip_passengers(direction, date, key):
         List with the chat IDs of the passengers, if any
 
     """
-    ref = db.reference(f"/Trips/{direction}/{date}/{key}/Passengers")
-    passengers_dict = ref.get()
-    if passengers_dict:
-        return list(passengers_dict)
-    else:
-        return list()
+    return _get_child_keys(f"/Trips/{direction}/{date}/{key}/Passengers")
 
 def get_number_of_passengers(direction, date, key):
     """Returns the number of confirmed passengers in a trip.
@@ -1052,12 +1597,7 @@ def get_number_of_passengers(direction, date, key):
         Number of passengers in the trip.
 
     """
-    ref = db.reference(f"/Trips/{direction}/{date}/{key}/Passengers")
-    passengers_dict = ref.get()
-    if passengers_dict:
-        return len(passengers_dict)
-    else:
-        return 0
+    return len(_get_child_keys(f"/Trips/{direction}/{date}/{key}/Passengers"))
 
 def remove_passenger(chat_id, direction, date, key):
     """Remove passenger given by chat_id to the specified trip.
@@ -1080,16 +1620,13 @@ def remove_passenger(chat_id, direction, date, key):
         False if the user was not a passenger in this trip.
 
     """
-    ref = db.reference(f"/Passengers/{chat_id}/{direction}/{date}/{key}")
-    if ref.get():
-        # Delete it from the passenger's own list of reserved trips
-        ref.delete()
-        # Now delete passenger from passenger list in trip info
-        ref = db.reference(f"/Trips/{direction}/{date}/{key}/Passengers")
-        ref.child(str(chat_id)).delete()
-    else:
+    if not is_passenger(chat_id, direction, date, key):
         return False
 
+    # Delete it from the passenger's own list and from the trip info at once
+    multi_path_update({f"/Passengers/{chat_id}/{direction}/{date}/{key}": None,
+                       f"/Trips/{direction}/{date}/{key}/Passengers/{chat_id}": None})
+
     return True
 
 def delete_all_reservations_from_passenger(chat_id):
@@ -1105,13 +1642,15 @@ def delete_all_reservations_from_passenger(chat_id):
     None
 
     """
-    ref = db.reference(f"/Passengers/{chat_id}")
+    ref = ScopedReference(f"/Passengers/{chat_id}")
     trips_dict = ref.get()
     if trips_dict:
+        paths = {f"/Passengers/{chat_id}": None}
         for dir in trips_dict:
             for date in trips_dict[dir]:
                 for trip_key in trips_dict[dir][date]:
-                    remove_passenger(chat_id, dir, date, trip_key)
+                    paths[f"/Trips/{dir}/{date}/{trip_key}/Passengers/{chat_id}"] = None
+        multi_path_update(paths)
 
 
 # Requests
@@ -1136,16 +1675,14 @@ def add_request(direction, chat_id, date, time):
         Key of the newly created DB reference.
 
     """
-    ref = db.reference(f"/Requests/{direction}/{date}")
-
     req_dict = {'Chat ID': chat_id,
                  'Time': time}
 
-    key = ref.push(req_dict).key
+    key = generate_push_key()
 
-    # Now add the key to the user's requests section
-    ref = db.reference(f"/Users/{chat_id}/Requests/{direction}/{date}/{key}")
-    ref.set(True)
+    # Write the request and its key in the user's requests section at once
+    multi_path_update({f"/Requests/{direction}/{date}/{key}": req_dict,
+                       f"/Users/{chat_id}/Requests/{direction}/{date}/{key}": True})
 
     return key
 
@@ -1167,8 +1704,10 @@ def delete_request(direction, date, key):
 
     """
     chat_id = get_request_chat_id(direction, date, key)
-    db.reference(f"/Requests/{direction}/{date}/{key}").delete()
-    db.reference(f"/Users/{chat_id}/Requests/{direction}/{date}/{key}").delete()
+    paths = {f"/Requests/{direction}/{date}/{key}": None}
+    if chat_id != None:
+        paths[f"/Users/{chat_id}/Requests/{direction}/{date}/{key}"] = None
+    multi_path_update(paths)
 
 def get_request(direction, date, key):
     """Gets a dictionary with the given request info.
@@ -1188,16 +1727,13 @@ def get_request(direction, date, key):
         Request information.
 
     """
-    ref = db.reference(f"/Requests/{direction}/{date}/{key}")
-    return ref.get()
+    return _get(f"/Requests/{direction}/{date}/{key}")
 
 def get_request_chat_id(direction, date, key):
-    ref = db.reference(f"/Requests/{direction}/{date}/{key}")
-    return ref.child('Chat ID').get()
+    return _get(f"/Requests/{direction}/{date}/{key}/Chat ID")
 
 def get_request_time(direction, date, key):
-    ref = db.reference(f"/Requests/{direction}/{date}/{key}")
-    return ref.child('Time').get()
+    return _get(f"/Requests/{direction}/{date}/{key}/Time")
 
 def get_requests_by_date_range(direction, date, time_start=None, time_end=None):
     """Gets a dictionary with the trip requests for a given date and,
@@ -1223,7 +1759,11 @@ def get_requests_by_date_range(direction, date, time_start=None, time_end=None):
          ...}
 
     """
-    ref = db.reference(f"/Requests/{direction}/{date}/")
+    found, date_dict = requests_mirror.get_range(direction, date, time_start, time_end)
+    if found:
+        return date_dict
+
+    ref = ScopedReference(f"/Requests/{direction}/{date}/")
     query = ref.order_by_child("Time")
 
     if time_start:
@@ -1255,50 +1795,12 @@ def get_requests_by_user(chat_id, date_start=None, date_end=None, order_by_date=
         Dictionary with the trip requests.
 
     """
-    ref = db.reference(f"/Users/{chat_id}/Requests")
-    reqs_dict = dict()
-
-    for dir in list(dir_dict.keys()):
-        query = ref.child(dir).order_by_key()
-        if date_start:
-            query = query.start_at(date_start)
-        if date_end:
-            query = query.end_at(date_end)
-
-        reqs_keys_dict = query.get()
-        if reqs_keys_dict:
-            dir_reqs = dict()
-            for date in reqs_keys_dict:
-                date_reqs = dict()
-                for key in reqs_keys_dict[date]:
-                    date_reqs[key] = get_request(dir, date, key)
-                if date_reqs:
-                    dir_reqs[date] = OrderedDict(
-                            sorted(date_reqs.items(), key=lambda x: x[1]['Time']))
-            if dir_reqs:
-                reqs_dict[dir] = dir_reqs
+    reqs_dict = _get_indexed_items(f"/Users/{chat_id}/Requests", "/Requests",
+                                   date_start, date_end)
 
     if reqs_dict:
         if order_by_date:
-            reqs_dict_by_date = dict()
-            dates = set()
-            # First narrow down the dates to process
-            for dir in reqs_dict:
-                dates = dates.union(set(reqs_dict[dir]))
-            # We want to present the requests by date
-            for date in sorted(dates):
-                date_reqs = dict()
-                for dir in reqs_dict:
-                    if date in reqs_dict[dir]:
-                        # Save the direction of each request in an specific field
-                        for key in reqs_dict[dir][date]:
-                            reqs_dict[dir][date][key]['Direction'] = dir
-                        date_reqs.update(reqs_dict[dir][date])
-                # Order dict by time if it exists
-                if date_reqs:
-                    reqs_dict_by_date[date] = OrderedDict(
-                            sorted(date_reqs.items(), key=lambda x: x[1]['Time']))
-            return reqs_dict_by_date
+            return _order_items_by_date(reqs_dict)
         return reqs_dict
     return
 
@@ -1325,16 +1827,13 @@ def get_requests_by_user_and_date(chat_id, direction, date, time_start=None, tim
         Dictionary with the trip requests.
 
     """
-    ref = db.reference(f"/Users/{chat_id}/Requests/{direction}/{date}")
+    reqs_keys = _get_child_keys(f"/Users/{chat_id}/Requests/{direction}/{date}")
 
     reqs_dict = dict()
-    reqs_keys_dict = ref.get()
-
-    if reqs_keys_dict:
-        for key in reqs_keys_dict:
-            req_aux = get_request(direction, date, key)
-            if time_end>=req_aux['Time']>=time_start:
-                reqs_dict[key] = req_aux
+    date_reqs = _get_children_by_keys(f"/Requests/{direction}/{date}", reqs_keys)
+    for key, req_aux in date_reqs.items():
+        if time_end>=req_aux['Time']>=time_start:
+            reqs_dict[key] = req_aux
 
     if reqs_dict:
         reqs_dict = OrderedDict(
@@ -1355,13 +1854,15 @@ def delete_all_requests_by_user(chat_id):
     None
 
     """
-    ref = db.reference(f"/Users/{chat_id}/Requests")
+    ref = ScopedReference(f"/Users/{chat_id}/Requests")
     reqs_dict = ref.get()
     if reqs_dict:
+        paths = {f"/Users/{chat_id}/Requests": None}
         for dir in reqs_dict:
             for date in reqs_dict[dir]:
                 for req_key in reqs_dict[dir][date]:
-                    delete_request(dir, date, req_key)
+                    paths[f"/Requests/{dir}/{date}/{req_key}"] = None
+        multi_path_update(paths)
 
 # Notifications
 
@@ -1384,7 +1885,7 @@ def get_offer_notification_by_user(chat_id, direction=None):
         If no notifications are set, it will be empty.
 
     """
-    ref = db.reference(f"/Users/{chat_id}/Offer Notifications")
+    ref = ScopedReference(f"/Users/{chat_id}/Offer Notifications")
 
     wd_aux = ['All days'] + weekdays_en
 
@@ -1423,7 +1924,7 @@ def get_request_notification_by_user(chat_id, direction=None):
         If no notifications are set, it will be empty.
 
     """
-    ref = db.reference(f"/Drivers/{chat_id}/Request Notifications")
+    ref = ScopedReference(f"/Drivers/{chat_id}/Request Notifications")
 
     wd_aux = ['All days'] + weekdays_en
 
@@ -1462,10 +1963,24 @@ def get_users_for_offer_notification(direction, weekday, time):
         chat_id's of the interested users.
 
     """
-    ref = db.reference(f"/Notifications/Offers/{direction}")
-
     hour = int(time[:2])
     minutes = int(time[-2:])
+
+    if offer_notif_mirror.is_loaded:
+        # Look up the in-memory index, without any network round trip
+        def index_entry(weekday, hour):
+            return offer_notif_mirror.snapshot(f"{direction}/{weekday}/{hour}") or dict()
+        hours = ['All hours', hour]
+        # If hour is o'clock, notify also the users just in the previous configured hour
+        if minutes == 0 and hour>0:
+            hours.append(hour-1)
+        users = set()
+        for wd in ['All days', weekday]:
+            for h in hours:
+                users.update(index_entry(wd, h))
+        return list(users)
+
+    ref = ScopedReference(f"/Notifications/Offers/{direction}")
     users = set()
 
     # Add users that get notified for every day and every hour
@@ -1511,7 +2026,7 @@ def get_users_for_request_notification(direction, weekday):
         chat_id's of the interested users.
 
     """
-    ref = db.reference(f"/Notifications/Requests/{direction}")
+    ref = ScopedReference(f"/Notifications/Requests/{direction}")
 
     users = set()
 
@@ -1553,75 +2068,75 @@ def modify_offer_notification(chat_id, direction, weekday=None, time_range=None)
         the chosen combination was already the same.
 
     """
-    ref = db.reference(f"/Users/{chat_id}/Offer Notifications/{direction}")
-    notif_dict = ref.get()
-    is_configured = False
-
-    # Update the user's dictionary
-    if weekday:
-        if weekday not in weekdays_en:
-            raise ValueError("weekday doesn't have a valid value")
-        if notif_dict!=None and weekday in notif_dict:
-            is_configured = True
-        else:
-            # If 'All days' was previously set, delete it
-            delete_offer_notification(chat_id, direction, 'All days')
-        # Set required reference
-        ref = ref.child(weekday)
-    else:
-        if notif_dict!=None and 'All days' in notif_dict:
-            is_configured = True
-        else:
-            delete_offer_notification(chat_id, direction)
-        ref = ref.child('All days')
-
-    # Configure user's weekday offers notifications dictionary
+    weekday = weekday if weekday else 'All days'
+    if weekday not in weekdays_en+['All days']:
+        raise ValueError("weekday doesn't have a valid value")
     if time_range:
         if time_range[0]>time_range[1] or time_range[0]<0 or time_range[1]>24:
             raise ValueError("time_range list doesn't have valid values")
-        ref.set({'Start': time_range[0], 'End': time_range[1]})
+        new_config = {'Start': time_range[0], 'End': time_range[1]}
     else:
-        ref.set(True)
-
-    weekday = 'All days' if not weekday else weekday
-    # Now update the general users notifications dictionary
-    ref2 = db.reference(f"/Notifications/Offers/{direction}/{weekday}")
-
-    # If this weekday option was already configured, we only modify it
-    if is_configured:
-        if notif_dict[weekday] == True:
-            if not time_range:
-                return False    # The configuration is the same!
-            else:
-                ref2.child('All hours').child(str(chat_id)).delete()
-                hours = list(range(time_range[0], time_range[1]))
-                for hour in hours:
-                    ref2.child(str(hour)).child(str(chat_id)).set(True)
-        else:
-            old_hours = list(range(notif_dict[weekday]['Start'], notif_dict[weekday]['End']))
-            if not time_range:
-                hours_to_delete = old_hours
-                ref2.child('All hours').child(str(chat_id)).set(True)
-            else:
-                hours = list(range(time_range[0], time_range[1]))
-                if old_hours==hours:
-                    return False    # The configuration is the same!
-                hours_to_delete = list(set(old_hours)-set(hours))
-                hours = list(set(hours)-set(old_hours))
-                for hour in hours:
-                    ref2.child(str(hour)).child(str(chat_id)).set(True)
-            for hour in hours_to_delete:
-                ref2.child(str(hour)).child(str(chat_id)).delete()
-    # If this weekday didn't have a previous configuration, create it
+        new_config = True
+
+    user_path = f"/Users/{chat_id}/Offer Notifications/{direction}"
+    notif_dict = ScopedReference(user_path).get() or dict()
+    if notif_dict.get(weekday) == new_config:
+        return False    # The configuration is the same!
+
+    # 'All days' and specific week days configurations are exclusive
+    if weekday == 'All days':
+        replaced_weekdays = list(notif_dict)
+        updates = {user_path: {weekday: new_config}}
     else:
-        if not time_range:
-            ref2.child('All hours').child(str(chat_id)).set(True)
-        else:
-            for hour in range(time_range[0], time_range[1]):
-                ref2.child(str(hour)).child(str(chat_id)).set(True)
+        replaced_weekdays = [wd for wd in (weekday, 'All days') if wd in notif_dict]
+        updates = {f"{user_path}/{weekday}": new_config}
+        if 'All days' in notif_dict:
+            updates[f"{user_path}/All days"] = None
+
+    # Compute the changes in the general users notifications dictionary
+    old_paths = set()
+    for wd in replaced_weekdays:
+        old_paths |= _offer_notif_index_paths(chat_id, direction, wd, notif_dict[wd])
+    new_paths = _offer_notif_index_paths(chat_id, direction, weekday, new_config)
+    for path in old_paths-new_paths:
+        updates[path] = None
+    for path in new_paths-old_paths:
+        updates[path] = True
+
+    # Both dictionaries change at once
+    multi_path_update(updates)
 
     return True
 
+def _offer_notif_index_paths(chat_id, direction, weekday, notif_config):
+    """Obtains the paths of the general offers' notifications dictionary that
+    correspond to a user's configuration for a week day.
+
+    Parameters
+    ----------
+    chat_id : int or string
+        chat_id of the user.
+    direction : string
+        Direction of the trip for notifications. Can be 'toBenalmadena' or 'toUMA'.
+    weekday : string
+        Must be 'All days' or one from ('Monday', ..., 'Sunday').
+    notif_config : True or dict
+        True if notifications are set for every hour, or a dictionary with
+        the 'Start' and 'End' hours otherwise.
+
+    Returns
+    -------
+    set(str)
+        Paths of the user's entries in the general dictionary.
+
+    """
+    index_path = f"/Notifications/Offers/{direction}/{weekday}"
+    if notif_config == True:   # Notifications set for every hour
+        return {f"{index_path}/All hours/{chat_id}"}
+    start_hour = int(notif_config['Start'])
+    end_hour = int(notif_config['End'])
+    return {f"{index_path}/{hour}/{chat_id}" for hour in range(start_hour, end_hour)}
+
 def modify_request_notification(chat_id, direction, weekday=None):
     """Modifies the requests' notifications for a given user, direction and,
     optionally, week day. It overwrites the previous configuration
@@ -1645,35 +2160,30 @@ def modify_request_notification(chat_id, direction, weekday=None):
         the chosen combination was already the same.
 
     """
-    ref = db.reference(f"/Drivers/{chat_id}/Request Notifications/{direction}")
-    notif_dict = ref.get()
-    is_configured = False
+    weekday = weekday if weekday else 'All days'
+    if weekday not in weekdays_en+['All days']:
+        raise ValueError("weekday doesn't have a valid value")
 
-    # Update the user's dictionary
-    if weekday:
-        if weekday not in weekdays_en:
-            raise ValueError("weekday doesn't have a valid value")
-        if notif_dict!=None and weekday in notif_dict:
-            return False
-        else:
-            # If 'All days' was previously set, delete it
-            delete_request_notification(chat_id, direction, 'All days')
-        # Set required reference
-        ref = ref.child(weekday)
-    else:
-        if notif_dict!=None and 'All days' in notif_dict:
-            return False
-        else:
-            delete_request_notification(chat_id, direction)
-        ref = ref.child('All days')
+    user_path = f"/Drivers/{chat_id}/Request Notifications/{direction}"
+    notif_dict = ScopedReference(user_path).get() or dict()
+    if weekday in notif_dict:
+        return False
 
-    # Enable notifications for this weekday
-    ref.set(True)
+    # 'All days' and specific week days configurations are exclusive
+    index_path = f"/Notifications/Requests/{direction}"
+    if weekday == 'All days':
+        updates = {user_path: {weekday: True}}
+        for wd in notif_dict:
+            updates[f"{index_path}/{wd}/{chat_id}"] = None
+    else:
+        updates = {f"{user_path}/{weekday}": True}
+        if 'All days' in notif_dict:
+            updates[f"{user_path}/All days"] = None
+            updates[f"{index_path}/All days/{chat_id}"] = None
+    updates[f"{index_path}/{weekday}/{chat_id}"] = True
 
-    weekday = 'All days' if not weekday else weekday
-    # Now update the general users notifications dictionary
-    ref2 = db.reference(f"/Notifications/Requests/{direction}/{weekday}")
-    ref2.child(str(chat_id)).set(True)
+    # Both dictionaries change at once
+    multi_path_update(updates)
 
     return True
 
@@ -1699,45 +2209,30 @@ def delete_offer_notification(chat_id, direction, weekday=None):
         chosen direction and weekday was not already configured.
 
     """
-    def remove_general_weekday_notif(chat_id, direction, weekday, notif_config):
-        """Auxiliary function for other notification database functions"""
-        # General users' notifications dictionary
-        ref2 = db.reference(f"/Notifications/Offers/{direction}/{weekday}")
-        # Delete from general users' notifications dictionary
-        if notif_config == True:   # Notifications set for every hour
-            ref2.child('All hours').child(str(chat_id)).delete()
-        else:
-            start_hour = int(notif_config['Start'])
-            end_hour = int(notif_config['End'])
-            for hour in range(start_hour, end_hour):
-                ref2.child(str(hour)).child(str(chat_id)).delete()
-
     # User's offers notifications dictionary
-    ref = db.reference(f"/Users/{chat_id}/Offer Notifications/{direction}")
+    user_path = f"/Users/{chat_id}/Offer Notifications/{direction}"
 
     if weekday:
         if weekday not in weekdays_en+['All days']:
             raise ValueError("weekday doesn't have a valid value")
-        weekday_notif_dict = ref.child(weekday).get()
+        weekday_notif_dict = ScopedReference(f"{user_path}/{weekday}").get()
         # Check if notification setting exists for this week day
         if weekday_notif_dict==None:
             return False
-
-        # Delete from user's dictionary
-        ref.child(weekday).delete()
-        # Delete from general users' notifications dictionary
-        remove_general_weekday_notif(chat_id, direction, weekday, weekday_notif_dict)
+        notif_dict = {weekday: weekday_notif_dict}
+        updates = {f"{user_path}/{weekday}": None}
     else:
-        dir_notif_dict = ref.get()
+        notif_dict = ScopedReference(user_path).get()
         # Check if there is any notification set for this direction
-        if dir_notif_dict==None:
+        if notif_dict==None:
             return False
+        updates = {user_path: None}
 
-        # Delete from user's dictionary
-        ref.delete()
-        # Delete from general users' notifications dictionary
-        for weekday in dir_notif_dict:
-            remove_general_weekday_notif(chat_id, direction, weekday, dir_notif_dict[weekday])
+    # Delete also from general users' notifications dictionary, at once
+    for wd in notif_dict:
+        for path in _offer_notif_index_paths(chat_id, direction, wd, notif_dict[wd]):
+            updates[path] = None
+    multi_path_update(updates)
 
     return True
 
@@ -1763,38 +2258,27 @@ def delete_request_notification(chat_id, direction, weekday=None):
         chosen direction and weekday was not already configured.
 
     """
-    def remove_general_weekday_notif(chat_id, direction, weekday):
-        """Auxiliary function for other notification database functions"""
-        # General users' notifications dictionary
-        ref2 = db.reference(f"/Notifications/Requests/{direction}/{weekday}")
-        # Delete from general users' notifications dictionary
-        ref2.child(str(chat_id)).delete()
-
     # Driver's requests notifications dictionary
-    ref = db.reference(f"/Drivers/{chat_id}/Request Notifications/{direction}")
+    user_path = f"/Drivers/{chat_id}/Request Notifications/{direction}"
 
     if weekday:
         if weekday not in weekdays_en+['All days']:
             raise ValueError("weekday doesn't have a valid value")
-        weekday_notif_dict = ref.child(weekday).get()
         # Check if notification setting exists for this week day
-        if weekday_notif_dict==None:
+        if ScopedReference(f"{user_path}/{weekday}").get()==None:
             return False
-
-        # Delete from user's dictionary
-        ref.child(weekday).delete()
-        # Delete from general users' notifications dictionary
-        remove_general_weekday_notif(chat_id, direction, weekday)
+        weekdays_list = [weekday]
+        updates = {f"{user_path}/{weekday}": None}
     else:
-        dir_notif_dict = ref.get()
+        weekdays_list = _get_child_keys(user_path)
         # Check if there is any notification set for this direction
-        if dir_notif_dict==None:
+        if not weekdays_list:
             return False
+        updates = {user_path: None}
 
-        # Delete from user's dictionary
-        ref.delete()
-        # Delete from general users' notifications dictionary
-        for weekday in dir_notif_dict:
-            remove_general_weekday_notif(chat_id, direction, weekday)
+    # Delete also from general users' notifications dictionary, at once
+    for wd in weekdays_list:
+        updates[f"/Notifications/Requests/{direction}/{wd}/{chat_id}"] = None
+    multi_path_update(updates)
 
     return True
@@ -0,0 +1,199 @@
+import logging, os, json, gzip, mmap, tempfile, threading
+from array import array
+from datetime import date, timedelta
+from data.archive import ARCHIVE_PATH
+from data.time_index import time_to_minutes
+from utils.common import dir_dict
+
+logger = logging.getLogger(__name__)
+
+# Columns of the trips tables, with their array typecodes. Dates are stored as
+# ordinals, directions as their index in dir_dict and times in minutes. Slots
+# are -1 when the number of seats is unknown, such as in the records archived
+# before their seats were resolved
+COLUMNS = [('date', 'i'), ('direction', 'b'), ('time', 'h'), ('slots', 'h'),
+           ('passengers', 'h'), ('driver', 'q')]
+# Extension of the decoded columns files, stored next to the archive files
+COLUMNS_EXTENSION = '.columns'
+
+class MonthTable:
+    """Columnar table with the archived trips of a month.
+
+    Parameters
+    ----------
+    columns : dict
+        Arrays (or memoryviews) with the values of each column in COLUMNS,
+        keyed by column name. All of them have the same length.
+
+    """
+
+    def __init__(self, columns):
+        self.columns = columns
+
+    def __len__(self):
+        return len(self.columns['date'])
+
+    @classmethod
+    def from_archive(cls, file_path):
+        """Builds the table of the trips found in a month's archive file."""
+        columns = {name: array(typecode) for name, typecode in COLUMNS}
+        directions = list(dir_dict)
+        with gzip.open(file_path, 'rt', encoding='utf-8') as file:
+            for line in file:
+                record = json.loads(line)
+                item = record['Item']
+                if record['Node'] != 'Trips' or not isinstance(item, dict):
+                    continue
+                columns['date'].append(date.fromisoformat(record['Date']).toordinal())
+                columns['direction'].append(directions.index(record['Direction']))
+                columns['time'].append(time_to_minutes(item['Time']))
+                seats = record.get('Seats', item.get('Slots'))
+                columns['slots'].append(int(seats) if seats is not None else -1)
+                columns['passengers'].append(len(item.get('Passengers') or {}))
+                columns['driver'].append(int(item['Chat ID']))
+        return cls(columns)
+
+    def save(self, file_path, source_stat):
+        """Writes the columns into a file that can be memory-mapped later.
+
+        The file starts with a line with the JSON header (number of rows and
+        size and modification time of the archive file), followed by the
+        columns' raw bytes, each one aligned to 8 bytes.
+
+        """
+        header = {'rows': len(self), 'size': source_stat.st_size,
+                  'mtime': source_stat.st_mtime}
+        # The old file may still be memory-mapped, so it is replaced instead
+        # of truncated
+        file = tempfile.NamedTemporaryFile(dir=os.path.dirname(file_path) or '.',
+                                           suffix='.tmp', delete=False)
+        try:
+            with file:
+                file.write(json.dumps(header).encode() + b'\n')
+                for name, _ in COLUMNS:
+                    file.write(b'\0' * (-file.tell() % 8))
+                    file.write(self.columns[name].tobytes())
+            os.replace(file.name, file_path)
+        except Exception:
+            os.remove(file.name)
+            raise
+
+    @classmethod
+    def load(cls, file_path, source_stat):
+        """Memory-maps a columns file written by `save`.
+
+        Returns
+        -------
+        MonthTable
+            The table, or None if the file is outdated or can't be read.
+
+        """
+        try:
+            with open(file_path, 'rb') as file:
+                header = json.loads(file.readline())
+                if header['size'] != source_stat.st_size or \
+                        header['mtime'] != source_stat.st_mtime:
+                    return None
+                offset = file.tell()
+                if header['rows'] == 0:
+                    return cls({name: array(typecode) for name, typecode in COLUMNS})
+                buffer = memoryview(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+        except (OSError, ValueError, KeyError):
+            return None
+        columns = dict()
+        for name, typecode in COLUMNS:
+            offset += -offset % 8
+            length = header['rows'] * array(typecode).itemsize
+            columns[name] = buffer[offset:offset+length].cast(typecode)
+            offset += length
+        return cls(columns)
+
+class TripHistory:
+    """Query engine over the trips archived in the local monthly files.
+
+    The tables of each month are built the first time they are needed and
+    then kept in memory. Their decoded columns are also saved next to the
+    archive files, so later loads just memory-map them.
+
+    Parameters
+    ----------
+    path : string
+        Folder of the archive files.
+
+    """
+
+    def __init__(self, path=ARCHIVE_PATH):
+        self.path = path
+        self._tables = dict()
+        self._lock = threading.Lock()
+
+    def _get_table(self, month):
+        """Gets the table of a month ('YYYY-mm'), or None if not archived."""
+        file_path = os.path.join(self.path, f"{month}.jsonl.gz")
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            return None
+        with self._lock:
+            cached = self._tables.get(month)
+            if cached and cached[0] == (stat.st_size, stat.st_mtime):
+                return cached[1]
+            columns_path = file_path + COLUMNS_EXTENSION
+            table = MonthTable.load(columns_path, stat)
+            if table is None:
+                table = MonthTable.from_archive(file_path)
+                try:
+                    table.save(columns_path, stat)
+                except OSError as e:
+                    logger.warning(f"Could not save {columns_path}: {str(e)}")
+            self._tables[month] = ((stat.st_size, stat.st_mtime), table)
+            return table
+
+    def aggregate(self, date_start, date_end, driver_id=None):
+        """Aggregates the archived trips between two dates by weekday.
+
+        Parameters
+        ----------
+        date_start : string
+            Range's start date with ISO format 'YYYY-mm-dd'.
+        date_end : string
+            Range's stop date with ISO format 'YYYY-mm-dd'.
+        driver_id : int or string
+            Optional. Only the trips of this driver are taken into account.
+
+        Returns
+        -------
+        list(dict)
+            For each weekday (Monday first), the number of 'Trips', the
+            number of 'Passengers', and the 'Seats' and 'Occupied' seats
+            of the trips whose number of seats is known.
+
+        """
+        start = date.fromisoformat(date_start)
+        end = date.fromisoformat(date_end)
+        first, last = start.toordinal(), end.toordinal()
+        driver = int(driver_id) if driver_id is not None else None
+        result = [{'Trips': 0, 'Passengers': 0, 'Seats': 0, 'Occupied': 0}
+                                                            for _ in range(7)]
+        month = start.replace(day=1)
+        while month <= end:
+            table = self._get_table(month.isoformat()[:7])
+            month = (month + timedelta(days=32)).replace(day=1)
+            if not table:
+                continue
+            columns = table.columns
+            for i, ordinal in enumerate(columns['date']):
+                if not first <= ordinal <= last:
+                    continue
+                if driver is not None and columns['driver'][i] != driver:
+                    continue
+                weekday = result[(ordinal-1) % 7]
+                passengers = columns['passengers'][i]
+                weekday['Trips'] += 1
+                weekday['Passengers'] += passengers
+                if columns['slots'][i] >= 0:
+                    weekday['Seats'] += columns['slots'][i]
+                    weekday['Occupied'] += passengers
+        return result
+
+trip_history = TripHistory()
@@ -0,0 +1,251 @@
+import logging, threading, copy
+from data.storage import get_backend, split_path
+
+logger = logging.getLogger(__name__)
+
+def normalize(data):
+    """Converts the lists returned by Firebase for nodes with numeric keys
+    (such as hours) back into dictionaries with string keys, recursively.
+
+    Parameters
+    ----------
+    data : object
+        Value obtained from the database.
+
+    Returns
+    -------
+    object
+        The same value, with every list replaced by a dictionary.
+
+    """
+    if isinstance(data, list):
+        return {str(i): normalize(value) for i, value in enumerate(data)
+                                                    if value is not None}
+    if isinstance(data, dict):
+        return {str(key): normalize(value) for key, value in data.items()}
+    return data
+
+class NodeMirror:
+    """In-memory copy of a database node.
+
+    The mirror is loaded once and then kept up to date either through a
+    Firebase stream listener or by calling `refresh` periodically. Reads are
+    served from memory, so they don't cost any network round trip.
+
+    Parameters
+    ----------
+    path : string
+        Database path of the node to mirror, such as '/Banned'.
+
+    """
+
+    def __init__(self, path):
+        self.path = '/' + '/'.join(split_path(path))
+        self._data = None
+        # Increased on every change, so derived data can tell when it is stale
+        self.version = 0
+        self._lock = threading.RLock()
+        self._loaded = threading.Event()
+        self._registration = None
+
+    @property
+    def is_loaded(self):
+        """Whether the mirror has already received the node's content."""
+        return self._loaded.is_set()
+
+    def start(self, stream=True, timeout=30):
+        """Loads the node and, optionally, starts listening to its changes.
+
+        Parameters
+        ----------
+        stream : boolean
+            If True, a stream listener keeps the mirror up to date. Otherwise
+            the content is loaded once and `refresh` must be called to update it.
+        timeout : float
+            Seconds to wait for the listener's initial snapshot before
+            falling back to a regular read.
+
+        Returns
+        -------
+        None
+
+        """
+        if stream:
+            try:
+                self._registration = get_backend().reference(self.path).listen(self._on_event)
+            except Exception as e:
+                logger.warning(f"Could not listen to {self.path}: {str(e)}")
+            if self._loaded.wait(timeout):
+                return
+        self.refresh()
+
+    def stop(self):
+        """Stops the stream listener, if any."""
+        if self._registration:
+            self._registration.close()
+            self._registration = None
+
+    def refresh(self):
+        """Reloads the whole node content from the database."""
+        data = normalize(get_backend().reference(self.path).get())
+        with self._lock:
+            self._data = data
+            self.version += 1
+        self._loaded.set()
+
+    def get(self, path=''):
+        """Gets the local value stored at the given path, relative to the
+        mirrored node.
+
+        Parameters
+        ----------
+        path : string
+            Relative path inside the mirrored node. Empty for the whole node.
+
+        Returns
+        -------
+        object
+            The stored value, or None if it doesn't exist.
+
+        """
+        with self._lock:
+            value = self._data
+            for segment in split_path(path):
+                if not isinstance(value, dict):
+                    return None
+                value = value.get(segment)
+            return value
+
+    def snapshot(self, path='', keys=None):
+        """Gets a copy of the local value stored at the given path, taken
+        with the lock held, so it can be iterated while the mirror changes.
+
+        Parameters
+        ----------
+        path : string
+            Relative path inside the mirrored node. Empty for the whole node.
+        keys : iterable of strings
+            Optional. If given, only these children of the value are copied,
+            in the same order, skipping the ones that don't exist.
+
+        Returns
+        -------
+        object
+            A copy of the stored value, or None if it doesn't exist.
+
+        """
+        with self._lock:
+            value = self.get(path)
+            if keys is not None:
+                if not isinstance(value, dict):
+                    return dict()
+                return {key: copy.deepcopy(value[key]) for key in keys if key in value}
+            return copy.deepcopy(value)
+
+    def put(self, path, data):
+        """Replaces the local value at the given relative path, deleting it
+        if data is None. Mirrors the semantics of a database `set()`.
+
+        Parameters
+        ----------
+        path : string
+            Relative path inside the mirrored node.
+        data : object
+            New value for that path.
+
+        Returns
+        -------
+        None
+
+        """
+        segments = split_path(path)
+        data = normalize(data)
+        with self._lock:
+            self.version += 1
+            if not segments:
+                self._data = data
+                return
+            if not isinstance(self._data, dict):
+                if data is None:
+                    return
+                self._data = dict()
+            # Walk down the tree keeping the parents to prune empty nodes
+            parents = []
+            node = self._data
+            for segment in segments[:-1]:
+                child = node.get(segment)
+                if not isinstance(child, dict):
+                    if data is None:
+                        return
+                    child = dict()
+                    node[segment] = child
+                parents.append((node, segment))
+                node = child
+            if data is None:
+                node.pop(segments[-1], None)
+                # Empty nodes don't exist in the database either
+                while parents and not node:
+                    parent, segment = parents.pop()
+                    del parent[segment]
+                    node = parent
+            else:
+                node[segments[-1]] = data
+
+    def patch(self, path, data):
+        """Updates the children of the local value at the given relative path.
+        Mirrors the semantics of a database `update()`.
+
+        Parameters
+        ----------
+        path : string
+            Relative path inside the mirrored node.
+        data : dict
+            Children to replace, keyed by their relative paths.
+
+        Returns
+        -------
+        None
+
+        """
+        with self._lock:
+            for key, value in data.items():
+                self.put(f"{path}/{key}", value)
+
+    def apply_update(self, updates):
+        """Applies a root-level multi-path update to the local copy, ignoring
+        the paths outside the mirrored node.
+
+        Parameters
+        ----------
+        updates : dict
+            Values keyed by their absolute database paths, as passed to
+            the root reference's `update()`.
+
+        Returns
+        -------
+        None
+
+        """
+        prefix = split_path(self.path)
+        with self._lock:
+            for path, value in updates.items():
+                segments = split_path(path)
+                if segments[:len(prefix)] == prefix:
+                    self.put('/'.join(segments[len(prefix):]), value)
+                elif prefix[:len(segments)] == segments:
+                    # The update replaces a parent of the mirrored node
+                    for segment in prefix[len(segments):]:
+                        value = value.get(segment) if isinstance(value, dict) else None
+                    self.put('', value)
+
+    def _on_event(self, event):
+        """Applies an event received from the stream listener."""
+        try:
+            if event.event_type == 'put':
+                self.put(event.path, event.data)
+                if not split_path(event.path):
+                    self._loaded.set()
+            elif event.event_type == 'patch':
+                self.patch(event.path, event.data)
+        except Exception as e:
+            logger.warning(f"Error applying event to {self.path} mirror: {str(e)}")
@@ -0,0 +1,144 @@
+import logging, copy
+from contextvars import ContextVar
+from data.storage import get_backend, split_path
+
+logger = logging.getLogger(__name__)
+
+# Scope of the update currently being handled, if any
+_current_scope = ContextVar('request_scope', default=None)
+
+def _is_related(path, other):
+    """Checks whether two paths are the same or one contains the other."""
+    path, other = path.rstrip('/') + '/', other.rstrip('/') + '/'
+    return path.startswith(other) or other.startswith(path)
+
+class RequestScope:
+    """Read cache and database calls counter for the handling of a single
+    update. The same node is only read once while the update is handled,
+    unless it is written in the meantime.
+
+    Parameters
+    ----------
+    name : str
+        Description of the update, used for logging.
+
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.reads = 0
+        self.hits = 0
+        self.writes = 0
+        self._values = dict()
+
+    def get(self, key, loader):
+        """Gets a cached read result, or loads and caches it.
+
+        Parameters
+        ----------
+        key : tuple
+            (path, shallow) tuple identifying the read.
+        loader : callable
+            Function that does the actual read.
+
+        Returns
+        -------
+        object
+            A copy of the read value, so callers can modify it.
+
+        """
+        if key in self._values:
+            self.hits += 1
+        else:
+            self.reads += 1
+            self._values[key] = loader()
+        return copy.deepcopy(self._values[key])
+
+    def invalidate(self, path):
+        """Forgets the cached reads of a path, its ancestors and its children."""
+        self.writes += 1
+        for key in [key for key in self._values if _is_related(key[0], path)]:
+            del self._values[key]
+
+    def log(self):
+        if self.reads or self.writes:
+            logger.info(f"{self.name}: {self.reads} database reads ({self.hits}"\
+                        f" avoided), {self.writes} writes")
+
+def begin_request_scope(name):
+    """Starts the scope of a new update, ending the previous one if any.
+
+    Parameters
+    ----------
+    name : str
+        Description of the update, used for logging.
+
+    Returns
+    -------
+    None
+
+    """
+    end_request_scope()
+    _current_scope.set(RequestScope(name))
+
+def end_request_scope():
+    """Ends the current update scope, logging its database calls count."""
+    scope = _current_scope.get()
+    if scope is not None:
+        scope.log()
+        _current_scope.set(None)
+
+class ScopedReference:
+    """Database reference whose reads are cached within the current update
+    scope, and whose writes invalidate them. Outside a scope, it behaves as
+    a regular reference.
+
+    Parameters
+    ----------
+    path : str
+        Database path.
+
+    """
+
+    def __init__(self, path):
+        self.path = '/' + '/'.join(split_path(path))
+        self._ref = get_backend().reference(self.path)
+
+    def child(self, path):
+        return ScopedReference(f"{self.path}/{path}")
+
+    def get(self, shallow=False):
+        scope = _current_scope.get()
+        if scope is None:
+            return self._ref.get(shallow=shallow)
+        return scope.get((self.path, shallow), lambda: self._ref.get(shallow=shallow))
+
+    def _invalidate(self, path=None):
+        scope = _current_scope.get()
+        if scope is not None:
+            scope.invalidate(path or self.path)
+
+    def set(self, value):
+        self._ref.set(value)
+        self._invalidate()
+
+    def update(self, value):
+        self._ref.update(value)
+        for key in value:
+            self._invalidate('/' + '/'.join(split_path(f"{self.path}/{key}")))
+
+    def delete(self):
+        self._ref.delete()
+        self._invalidate()
+
+    def transaction(self, transaction_update):
+        result = self._ref.transaction(transaction_update)
+        self._invalidate()
+        return result
+
+    def __getattr__(self, name):
+        # Queries (order_by_child, order_by_key...) are not cached
+        scope = _current_scope.get()
+        if scope is not None:
+            scope.reads += 1
+        return getattr(self._ref, name)
@@ -0,0 +1,360 @@
+import logging, threading, copy
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+def split_path(path):
+    """Splits a database path into its non-empty segments.
+
+    Parameters
+    ----------
+    path : string
+        Database path, such as '/Users/1234/Name'.
+
+    Returns
+    -------
+    list(str)
+        Path segments, such as ['Users', '1234', 'Name'].
+
+    """
+    return [segment for segment in str(path).split('/') if segment]
+
+class StorageBackend:
+    """Storage where the bot's data lives. Backends give access to it through
+    reference objects with the interface of Firebase's `db.Reference`:
+
+    - `get(shallow=False)`, `set(value)`, `update(dict)`, `push(value)`,
+      `delete()`, `transaction(function)`, `child(path)` and `listen(callback)`.
+    - Ordered range queries with `order_by_child(child)`, `order_by_key()` or
+      `order_by_value()`, followed by `start_at`, `end_at`, `equal_to`,
+      `limit_to_first` or `limit_to_last` and a final `get()`.
+
+    """
+
+    def reference(self, path='/'):
+        """Gets a reference to a database path."""
+        raise NotImplementedError
+
+class FirebaseBackend(StorageBackend):
+    """Firebase Realtime Database backend. The app must have been initialized
+    with `firebase_admin.initialize_app` before using it."""
+
+    def reference(self, path='/'):
+        from firebase_admin import db
+        return db.reference(path)
+
+# Ordering
+
+def _value_order(value):
+    """Sort key of a value following Firebase's ordering: null, false, true,
+    numbers, strings and objects."""
+    if value is None:
+        return (0,)
+    if isinstance(value, bool):
+        return (1, value)
+    if isinstance(value, (int, float)):
+        return (2, value)
+    if isinstance(value, str):
+        return (3, value)
+    return (4,)
+
+def _key_order(key):
+    """Sort key of a child key following Firebase's ordering: keys that are
+    32-bit integers first, in numerical order, and then the rest of them in
+    lexicographical order."""
+    try:
+        number = int(key)
+        if str(number) == key and -2**31 <= number < 2**31:
+            return (0, number, '')
+    except ValueError:
+        pass
+    return (1, 0, key)
+
+def _clean(value):
+    """Copies a value as Firebase stores it: without empty nodes nor null
+    children, and with string keys."""
+    if isinstance(value, (list, tuple)):
+        value = {str(i): child for i, child in enumerate(value)}
+    if isinstance(value, dict):
+        cleaned = {str(key): _clean(child) for key, child in value.items()}
+        cleaned = {key: child for key, child in cleaned.items() if child is not None}
+        return cleaned or None
+    return value
+
+class _Event:
+    """Change notified to the listeners, like Firebase's `db.Event`."""
+    def __init__(self, event_type, path, data):
+        self.event_type = event_type
+        self.path = path
+        self.data = data
+
+class _Registration:
+    """Handle of a listener, like Firebase's `db.ListenerRegistration`."""
+    def __init__(self, backend, listener):
+        self._backend = backend
+        self._listener = listener
+
+    def close(self):
+        with self._backend._lock:
+            if self._listener in self._backend._listeners:
+                self._backend._listeners.remove(self._listener)
+
+class MemoryQuery:
+    """Ordered range query over an in-memory node."""
+
+    def __init__(self, reference, order_by, child=None):
+        self._reference = reference
+        self._order_by = order_by
+        self._child = child
+        self._start = None
+        self._end = None
+        self._limit = None
+
+    def _order(self, key, value):
+        if self._order_by == 'key':
+            return _key_order(key)
+        if self._order_by == 'child':
+            for segment in split_path(self._child):
+                value = value.get(segment) if isinstance(value, dict) else None
+        return _value_order(value) + (_key_order(key),)
+
+    def _bound(self, bound):
+        if self._order_by == 'key':
+            return _key_order(str(bound))
+        return _value_order(bound)
+
+    def start_at(self, start):
+        self._start = start
+        return self
+
+    def end_at(self, end):
+        self._end = end
+        return self
+
+    def equal_to(self, value):
+        self._start = self._end = value
+        return self
+
+    def limit_to_first(self, limit):
+        self._limit = ('first', limit)
+        return self
+
+    def limit_to_last(self, limit):
+        self._limit = ('last', limit)
+        return self
+
+    def get(self):
+        children = self._reference.get()
+        if not isinstance(children, dict):
+            return OrderedDict()
+        items = sorted(children.items(), key=lambda x: self._order(*x))
+        if self._start is not None:
+            start = self._bound(self._start)
+            items = [x for x in items if self._order(*x)[:len(start)] >= start]
+        if self._end is not None:
+            end = self._bound(self._end)
+            items = [x for x in items if self._order(*x)[:len(end)] <= end]
+        if self._limit:
+            side, limit = self._limit
+            items = items[:limit] if side == 'first' else items[-limit:]
+        return OrderedDict(items)
+
+class MemoryReference:
+    """Reference to a path of a `MemoryBackend`."""
+
+    def __init__(self, backend, path):
+        self._backend = backend
+        self.path = '/' + '/'.join(split_path(path))
+
+    @property
+    def key(self):
+        segments = split_path(self.path)
+        return segments[-1] if segments else None
+
+    def child(self, path):
+        return MemoryReference(self._backend, f"{self.path}/{path}")
+
+    def get(self, shallow=False):
+        value = self._backend.read(self.path)
+        if shallow and isinstance(value, dict):
+            return {key: True if isinstance(child, dict) else child
+                    for key, child in value.items()}
+        return value
+
+    def set(self, value):
+        self._backend.write({self.path: value})
+
+    def update(self, value):
+        self._backend.write({f"{self.path}/{key}": child
+                             for key, child in value.items()})
+
+    def delete(self):
+        self._backend.write({self.path: None})
+
+    def push(self, value=''):
+        from data.database_api import generate_push_key
+        reference = self.child(generate_push_key())
+        reference.set(value)
+        return reference
+
+    def transaction(self, transaction_update):
+        with self._backend._lock:
+            value = transaction_update(self._backend.read(self.path))
+            self._backend.write({self.path: value})
+            return self._backend.read(self.path)
+
+    def listen(self, callback):
+        return self._backend.listen(self.path, callback)
+
+    def order_by_child(self, path):
+        return MemoryQuery(self, 'child', path)
+
+    def order_by_key(self):
+        return MemoryQuery(self, 'key')
+
+    def order_by_value(self):
+        return MemoryQuery(self, 'value')
+
+class MemoryBackend(StorageBackend):
+    """Thread-safe in-memory database with the path semantics of Firebase's
+    Realtime Database, useful to run the bot locally without a Firebase
+    project, for example for load tests.
+
+    Parameters
+    ----------
+    data : dict
+        Optional. Initial content of the database, such as a JSON export
+        of a Firebase project.
+
+    """
+
+    def __init__(self, data=None):
+        self._data = _clean(data)
+        self._lock = threading.RLock()
+        self._listeners = []
+
+    def reference(self, path='/'):
+        return MemoryReference(self, path)
+
+    def read(self, path):
+        """Gets a copy of the value stored at an absolute path."""
+        with self._lock:
+            value = self._data
+            for segment in split_path(path):
+                if not isinstance(value, dict):
+                    return None
+                value = value.get(segment)
+            return copy.deepcopy(value)
+
+    def _put(self, segments, value):
+        """Replaces the value at a path, pruning the nodes left empty. Must
+        be called with the lock held."""
+        if not segments:
+            self._data = value
+            return
+        if not isinstance(self._data, dict):
+            if value is None:
+                return
+            self._data = dict()
+        parents = []
+        node = self._data
+        for segment in segments[:-1]:
+            child = node.get(segment)
+            if not isinstance(child, dict):
+                if value is None:
+                    return
+                child = node[segment] = dict()
+            parents.append((node, segment))
+            node = child
+        if value is None:
+            node.pop(segments[-1], None)
+            while parents and not node:
+                parent, segment = parents.pop()
+                del parent[segment]
+                node = parent
+            if not self._data:
+                self._data = None
+        else:
+            node[segments[-1]] = value
+
+    def write(self, updates):
+        """Writes several absolute paths at once, atomically. None values
+        delete their paths.
+
+        Parameters
+        ----------
+        updates : dict
+            New values keyed by their absolute paths.
+
+        Returns
+        -------
+        None
+
+        """
+        updates = {tuple(split_path(path)): _clean(value)
+                                            for path, value in updates.items()}
+        for segments in updates:
+            for other in updates:
+                if other != segments and other[:len(segments)] == segments:
+                    raise ValueError(f"Paths /{'/'.join(segments)} and "\
+                                     f"/{'/'.join(other)} overlap in the update.")
+        with self._lock:
+            for segments, value in updates.items():
+                self._put(list(segments), value)
+            events = self._get_events(updates)
+        for callback, event in events:
+            try:
+                callback(event)
+            except Exception as e:
+                logger.warning(f"Error in listener of {event.path}: {str(e)}")
+
+    def listen(self, path, callback):
+        """Calls back with the current value of a path and then with every
+        change to it, like Firebase's `Reference.listen`."""
+        segments = tuple(split_path(path))
+        listener = (segments, callback)
+        with self._lock:
+            self._listeners.append(listener)
+            value = self.read(path)
+        callback(_Event('put', '/', value))
+        return _Registration(self, listener)
+
+    def _get_events(self, updates):
+        """Obtains the events of the listeners affected by an update. Must
+        be called with the lock held."""
+        events = []
+        for segments, callback in self._listeners:
+            for written in updates:
+                if written[:len(segments)] == segments:
+                    relative = '/' + '/'.join(written[len(segments):])
+                    value = self.read('/'.join(written))
+                elif segments[:len(written)] == written:
+                    relative, value = '/', self.read('/'.join(segments))
+                else:
+                    continue
+                events.append((callback, _Event('put', relative, value)))
+        return events
+
+# Backend used by the database functions
+_backend = FirebaseBackend()
+
+def get_backend():
+    """Gets the storage backend in use."""
+    return _backend
+
+def set_backend(backend):
+    """Replaces the storage backend. Must be called before using the database.
+
+    Parameters
+    ----------
+    backend : StorageBackend
+        The new backend, such as `MemoryBackend()`.
+
+    Returns
+    -------
+    None
+
+    """
+    global _backend
+    _backend = backend
+    logger.info(f"Using {type(backend).__name__} as storage backend.")
@@ -0,0 +1,90 @@
+import json
+from bisect import bisect_left, bisect_right
+
+# Children queried with order_by_child(), which need an '.indexOn' rule so the
+# server doesn't download and sort the whole node ('$' marks wildcard segments)
+INDEXED_CHILDREN = {'/Trips/$direction/$date': ['Time'],
+                    '/Requests/$direction/$date': ['Time']}
+
+def time_to_minutes(time):
+    """Converts a time with ISO format 'HH:MM' into minutes since midnight.
+
+    Parameters
+    ----------
+    time : string
+        Time with ISO format 'HH:MM'.
+
+    Returns
+    -------
+    int
+        Minutes since midnight.
+
+    """
+    hours, minutes = time.split(':')[:2]
+    return int(hours)*60 + int(minutes)
+
+class TimeIndex:
+    """Keys of the trips or requests of a single date, sorted by departure
+    time, so that time range lookups cost O(log n + k) through bisection.
+    Items without time are not indexed.
+
+    Parameters
+    ----------
+    items_dict : dict
+        Items of a single date, keyed by their unique keys.
+
+    """
+
+    def __init__(self, items_dict):
+        entries = sorted((time_to_minutes(item['Time']), key)
+                         for key, item in (items_dict or dict()).items()
+                         if isinstance(item, dict) and item.get('Time'))
+        self._minutes = [minutes for minutes, _ in entries]
+        self._keys = [key for _, key in entries]
+
+    def __len__(self):
+        return len(self._keys)
+
+    def range(self, time_start=None, time_end=None):
+        """Gets the keys of the items within a time range, both included.
+
+        Parameters
+        ----------
+        time_start : string
+            Range's start time with ISO format 'HH:MM'. Optional.
+        time_end : string
+            Range's stop time with ISO format 'HH:MM'. Optional.
+
+        Returns
+        -------
+        list(str)
+            Keys of the items within the range, ordered by time.
+
+        """
+        start = bisect_left(self._minutes, time_to_minutes(time_start)) \
+                                                if time_start else 0
+        end = bisect_right(self._minutes, time_to_minutes(time_end)) \
+                                                if time_end else len(self._keys)
+        return self._keys[start:end]
+
+def get_database_rules():
+    """Builds the Realtime Database rules with the '.indexOn' entries needed
+    by the bot's queries. They must be merged with the project's read and
+    write rules before deploying them.
+
+    Returns
+    -------
+    dict
+        Rules with format {'rules': {<node>: {... {'.indexOn': [<child>]}}}}.
+
+    """
+    rules = dict()
+    for path, children in INDEXED_CHILDREN.items():
+        node = rules
+        for segment in path.strip('/').split('/'):
+            node = node.setdefault(segment, dict())
+        node['.indexOn'] = children
+    return {'rules': rules}
+
+if __name__ == '__main__':
+    print(json.dumps(get_database_rules(), indent=2))
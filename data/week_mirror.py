@@ -0,0 +1,176 @@
+import logging, threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from data.mirror import NodeMirror, split_path
+from data.time_index import TimeIndex
+
+logger = logging.getLogger(__name__)
+
+class WeekMirror:
+    """In-memory copy of the dates of a {direction: {date: {key: item}}}
+    database node (such as '/Trips') that fall within a rolling window.
+
+    Each direction and date is kept in its own `NodeMirror`, so only the
+    window's dates are downloaded and listened to, along with a `TimeIndex`
+    rebuilt whenever the date changes. Dates outside the window are not
+    covered and must be read from the database.
+
+    Parameters
+    ----------
+    path : string
+        Database path of the node, such as '/Trips'.
+    directions : iterable of strings
+        Directions stored in the node.
+
+    """
+
+    def __init__(self, path, directions):
+        self.path = '/' + '/'.join(split_path(path))
+        self.directions = list(directions)
+        self.stream = True
+        self.hits = 0
+        self.misses = 0
+        self._mirrors = dict()
+        self._indexes = dict()
+        self._lock = threading.Lock()
+
+    @property
+    def dates(self):
+        """Dates currently within the window."""
+        return sorted({date for _, date in self._mirrors})
+
+    def roll(self, dates):
+        """Moves the window to the given dates, loading the new ones and
+        stopping the mirrors of the dates which are left behind.
+
+        Parameters
+        ----------
+        dates : list of strings
+            Dates with ISO format 'YYYY-mm-dd' to keep in memory.
+
+        Returns
+        -------
+        None
+
+        """
+        with self._lock:
+            current = dict(self._mirrors)
+        wanted = [(dir, date) for dir in self.directions for date in dates]
+        new = {id: NodeMirror(f"{self.path}/{id[0]}/{id[1]}")
+                                for id in wanted if id not in current}
+        if new:
+            with ThreadPoolExecutor(len(new)) as executor:
+                list(executor.map(lambda mirror: mirror.start(self.stream),
+                                  new.values()))
+        mirrors = {id: current.get(id) or new[id] for id in wanted}
+        with self._lock:
+            self._mirrors = mirrors
+            self._indexes = {id: self._indexes[id] for id in self._indexes
+                                                        if id in mirrors}
+        for id, mirror in current.items():
+            if id not in mirrors:
+                mirror.stop()
+        logger.info(f"{self.path} window moved to {dates[0]} - {dates[-1]}.")
+
+    def start(self, dates, stream=True):
+        """Loads the given dates and keeps them updated through streaming or,
+        if stream is False, through `refresh`."""
+        self.stream = stream
+        self.roll(dates)
+
+    def refresh(self):
+        """Reloads every date of the window from the database."""
+        for mirror in list(self._mirrors.values()):
+            mirror.refresh()
+
+    def _get_mirror(self, direction, date):
+        mirror = self._mirrors.get((direction, date))
+        return mirror if mirror and mirror.is_loaded else None
+
+    def lookup(self, path):
+        """Gets the local value of a database path, if it is covered.
+
+        Parameters
+        ----------
+        path : string
+            Absolute database path, such as '/Trips/toUMA/2022-05-03/<key>'.
+
+        Returns
+        -------
+        (boolean, object)
+            Whether the path is within the window, and a copy of its value
+            (None if it doesn't exist).
+
+        """
+        segments = split_path(path)
+        prefix = split_path(self.path)
+        if segments[:len(prefix)] != prefix or len(segments) < len(prefix)+2:
+            return False, None
+        direction, date = segments[len(prefix):len(prefix)+2]
+        mirror = self._get_mirror(direction, date)
+        if mirror is None:
+            self.misses += 1
+            return False, None
+        self.hits += 1
+        return True, mirror.snapshot('/'.join(segments[len(prefix)+2:]))
+
+    def _get_index(self, id, mirror):
+        """Gets the time index of a date, rebuilding it if it is stale."""
+        # The version is read first, so a change during the copy just makes
+        # the index be rebuilt on the next lookup
+        version = mirror.version
+        index_version, index = self._indexes.get(id, (None, None))
+        if index_version != version:
+            index = TimeIndex(mirror.snapshot())
+            self._indexes[id] = (version, index)
+        return index
+
+    def get_range(self, direction, date, time_start=None, time_end=None, keys=None):
+        """Gets the items of a date within a time range, ordered by time, as
+        an `order_by_child('Time')` query would return them.
+
+        Parameters
+        ----------
+        direction : string
+            Direction of the items. Can be 'toBenalmadena' or 'toUMA'.
+        date : string
+            Date with ISO format 'YYYY-mm-dd'.
+        time_start : string
+            Range's start time with ISO format 'HH:MM'. Optional.
+        time_end : string
+            Range's stop time with ISO format 'HH:MM'. Optional.
+        keys : iterable of strings
+            Keys of the items to get. Optional, all of them by default.
+
+        Returns
+        -------
+        (boolean, OrderedDict)
+            Whether the date is within the window, and a copy of the items
+            within the time range.
+
+        """
+        mirror = self._get_mirror(direction, date)
+        if mirror is None:
+            self.misses += 1
+            return False, None
+        self.hits += 1
+        index = self._get_index((direction, date), mirror)
+        selected = index.range(time_start, time_end)
+        if keys is not None:
+            keys = set(keys)
+            selected = [key for key in selected if key in keys]
+        return True, OrderedDict(mirror.snapshot('', selected).items())
+
+    def apply_update(self, updates):
+        """Applies a root-level multi-path update to the local copies."""
+        for mirror in list(self._mirrors.values()):
+            if mirror.is_loaded:
+                mirror.apply_update(updates)
+
+    def stats(self):
+        """Returns a dictionary with the number of items in memory and the
+        lookup hit/miss counters, like `TTLCache.stats`."""
+        mirrors = [(id, mirror) for id, mirror in self._mirrors.items()
+                                                    if mirror.is_loaded]
+        return {'size': sum(len(self._get_index(id, mirror)) for id, mirror in mirrors),
+                'hits': self.hits, 'misses': self.misses}
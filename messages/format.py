@@ -1,6 +1,6 @@
 import logging, re
-from data.database_api import (get_name, is_driver, get_slots, get_car,
-                               get_home, get_univ, get_phone,
+from data.database_api import (get_name, get_names, is_driver, get_slots,
+                               get_car, get_home, get_univ, get_phone,
                                get_fee, get_bizum, get_trip,
                                get_trips_by_date_range, get_trips_by_driver,
                                get_trips_by_passenger,
@@ -11,12 +11,35 @@ from data.database_api import (get_name, is_driver, get_slots, get_car,
 from telegram.utils.helpers import escape_markdown
 from utils.common import *
 
-def get_markdown2_inline_mention(chat_id):
-    name = get_name(chat_id)
+def get_markdown2_inline_mention(chat_id, name=None):
+    if not name:
+        name = get_name(chat_id)
     if not name:
         name = str(chat_id)
     return f"[{escape_markdown(name,2)}](tg://user?id={chat_id})"
 
+def prefetch_names(items):
+    """Loads at once into the names cache the names of the users (drivers,
+    requesters and passengers) of several trips or requests.
+
+    Parameters
+    ----------
+    items : iterable of dicts
+        Trips or requests data.
+
+    Returns
+    -------
+    None
+
+    """
+    chat_ids = set()
+    for item in items:
+        if 'Chat ID' in item:
+            chat_ids.add(item['Chat ID'])
+        chat_ids.update(item.get('Passengers', []))
+    if chat_ids:
+        get_names(chat_ids)
+
 def get_formatted_user_config(chat_id):
     """Generates a formatted string with the user configuration.
 
@@ -106,10 +129,13 @@ def format_trip_from_data(direction=None, date=None, chat_id=None, time=None,
 
     """
     fields = []
+    # Get all the needed names at once
+    names = get_names(([chat_id] if chat_id else []) + list(passenger_ids or []))
 
     if not is_abbreviated:
         if chat_id:
-            fields.append(f"🧑 *Conductor*: {get_markdown2_inline_mention(chat_id)}")
+            mention = get_markdown2_inline_mention(chat_id, names.get(str(chat_id)))
+            fields.append(f"🧑 *Conductor*: {mention}")
         if direction:
             fields.append(f"📍 *Dirección*: `{dir_dict.get(direction, direction[2:])}`")
         if origin and dest:
@@ -145,12 +171,13 @@ def format_trip_from_data(direction=None, date=None, chat_id=None, time=None,
                 str_aux += f" `({phone})`"
             fields.append(str_aux)
         if passenger_ids:
-            passenger_strings = [get_markdown2_inline_mention(id) for id in passenger_ids]
+            passenger_strings = [get_markdown2_inline_mention(id, names.get(str(id)))
+                                                        for id in passenger_ids]
             fields.append(f"👥 *Pasajeros aceptados*: {', '.join(passenger_strings)}")
         string = '\n'.join(fields)
     else:
         if chat_id:
-            fields.append(f"🧑 {get_name(chat_id)}")
+            fields.append(f"🧑 {names.get(str(chat_id))}")
         if direction:
             fields.append(f"📍 {dir_dict.get(direction, direction[2:])}")
         if origin and dest:
@@ -176,7 +203,7 @@ def format_trip_from_data(direction=None, date=None, chat_id=None, time=None,
         if bizum != None:
             fields.append(f"💳 {'OK' if bizum else 'NO'}")
         if passenger_ids:
-            passenger_strings = [get_name(id) for id in passenger_ids]
+            passenger_strings = [str(names.get(str(id))) for id in passenger_ids]
             fields.append(f"👥 {', '.join(passenger_strings)}")
         string = '  '.join(fields)
 
@@ -335,6 +362,8 @@ def get_formatted_offered_trips(direction, date, time_start=None, time_stop=None
     """
     trips_dict = get_trips_by_date_range(direction, date, time_start, time_stop)
     index = 1
+    if trips_dict:
+        prefetch_names(trips_dict.values())
 
     string_list = []
     key_list = []
@@ -398,6 +427,8 @@ def get_formatted_trips_near_request(direction, date, time):
     """
     time_before, time_after = get_time_range_from_center_time(time, 1)
     trips_dict = get_trips_by_date_range(direction, date, time_before, time_after)
+    if trips_dict:
+        prefetch_names(trips_dict.values())
 
     string_list = []
     # key_list = []
@@ -544,6 +575,8 @@ def get_formatted_requests(direction, date, time_start=None, time_stop=None):
     """
     reqs_dict = get_requests_by_date_range(direction, date, time_start, time_stop)
     index = 1
+    if reqs_dict:
+        prefetch_names(reqs_dict.values())
 
     string_list = []
     key_list = []
@@ -587,6 +620,7 @@ def get_driver_week_formatted_trips(chat_id):
     string = ""
     week_string_list = []
     if trips_dict:
+        prefetch_names(trip for date in trips_dict for trip in trips_dict[date].values())
         for date in trips_dict:
             # Format string with trips
             header = f"*{weekday_strings[week_strings.index(date)]} "\
@@ -634,6 +668,7 @@ def get_user_week_formatted_bookings(chat_id):
     string = ""
     week_string_list = []
     if trips_dict:
+        prefetch_names(trip for date in trips_dict for trip in trips_dict[date].values())
         for date in trips_dict:
             # Format string with trips
             header = f"*{weekday_strings[week_strings.index(date)]} "\
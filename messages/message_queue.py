@@ -1,38 +1,653 @@
-import logging, telegram, math
+import logging, telegram, threading, random, uuid
+from os import environ
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
 from telegram.ext import CallbackContext
-from datetime import datetime, timedelta
+from telegram.error import Unauthorized, BadRequest, RetryAfter, NetworkError
 from messages.format import get_markdown2_inline_mention
-from utils.common import *
+from messages.outbox import Outbox
+from data.database_api import set_unreachable, get_names, deletion_listeners
 
 logger = logging.getLogger(__name__)
 
-minimum_time_delta = timedelta(milliseconds=100)
+# Telegram allows about 30 messages per second overall and 1 per second per chat
+MQ_GLOBAL_RATE = float(environ.get('MQ_GLOBAL_RATE', '30'))
+MQ_GLOBAL_BURST = int(environ.get('MQ_GLOBAL_BURST', '30'))
+MQ_CHAT_RATE = float(environ.get('MQ_CHAT_RATE', '1'))
+MQ_CHAT_BURST = int(environ.get('MQ_CHAT_BURST', '1'))
+# Local file where accepted messages are stored until they are sent
+MQ_OUTBOX_PATH = environ.get('MQ_OUTBOX_PATH', 'outbox.sqlite3')
+# Retries for messages that failed because of transient errors
+MQ_MAX_RETRIES = int(environ.get('MQ_MAX_RETRIES', '5'))
+MQ_BACKOFF_BASE = float(environ.get('MQ_BACKOFF_BASE', '1'))
+MQ_BACKOFF_MAX = float(environ.get('MQ_BACKOFF_MAX', '60'))
+# Threads sending messages at the same time. Each one waits for Telegram's
+# answer, so reaching the global rate takes about rate*latency of them
+MQ_WORKERS = int(environ.get('MQ_WORKERS', '32'))
 
-def callback_send_message(context):
-    message_dict = context.job.context
+# Priority classes of the outgoing messages, from highest to lowest
+PRIORITY_INTERACTIVE = 0     # Direct answers to a user's action
+PRIORITY_TRANSACTIONAL = 1   # Bookings, cancellations, bans...
+PRIORITY_NOTIFICATION = 2    # New trips and requests notifications
+PRIORITY_BULK = 3            # Broadcasts
+priority_names = ['Interactive', 'Transactional', 'Notification', 'Bulk']
+
+# Kinds of errors when sending a message
+ERROR_RETRY_AFTER = 'retry_after'   # Flood limit exceeded, wait and retry
+ERROR_TRANSIENT = 'transient'       # Network problems, retry with backoff
+ERROR_PERMANENT = 'permanent'       # Blocked bot, chat not found... don't retry
+
+# Message waiting in the queue, not to be sent before the not_before time
+QueuedMessage = namedtuple('QueuedMessage', ['enqueued', 'chat_id', 'message_dict',
+                                            'outbox_id', 'attempt', 'not_before'])
+
+_mq_lock = threading.Lock()
+
+class TokenBucket:
+    """Token bucket rate limiter. Tokens are refilled continuously at a fixed
+    rate up to the bucket capacity, and each sent message consumes one.
+
+    Parameters
+    ----------
+    rate : float
+        Tokens added per second.
+    capacity : int
+        Maximum number of tokens, i.e. the allowed burst size.
+
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = max(1, capacity)
+        self.tokens = self.capacity
+        self.last = monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now-self.last)*self.rate)
+        self.last = now
+
+    def wait_time(self, now):
+        """Returns the seconds to wait until a token is available."""
+        self._refill(now)
+        return 0 if self.tokens >= 1 else (1-self.tokens)/self.rate
+
+    def consume(self, now):
+        """Takes one token. `wait_time` must have returned 0 before."""
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_full(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+class MessageQueue:
+    """Queue of outgoing messages that are dispatched respecting a global
+    token bucket and one token bucket per chat, so that Telegram's flood limits
+    are never hit while sending as fast as they allow.
+
+    Messages are kept in one lane per priority class. A dispatcher thread takes
+    the oldest message of the highest priority lane whose chat can receive it,
+    so a broadcast never delays a booking confirmation, and hands it to one
+    of the queue's sending threads, so slow requests to Telegram don't delay
+    the following messages. Messages are only taken from the lanes when a
+    thread is free to send them.
+
+    If an outbox is given, messages are stored in it before being queued, and
+    the ones that were still pending when the bot stopped are queued again.
+
+    Messages can be tagged with the database path of the trip or request they
+    refer to. When that path is deleted, the queued messages with its tag are
+    revoked and never sent.
+
+    Parameters
+    ----------
+    job_queue : telegram.ext.JobQueue
+        Job queue of the bot, whose dispatcher gives the context to send
+        the messages.
+    global_rate, global_burst : float, int
+        Rate and burst size for the whole bot.
+    chat_rate, chat_burst : float, int
+        Rate and burst size for each chat.
+    outbox : Outbox
+        Optional. Durable storage for the queued messages.
+    workers : int
+        Number of threads sending messages.
+
+    """
+
+    def __init__(self, job_queue, outbox=None, global_rate=MQ_GLOBAL_RATE,
+                global_burst=MQ_GLOBAL_BURST, chat_rate=MQ_CHAT_RATE,
+                chat_burst=MQ_CHAT_BURST, workers=MQ_WORKERS):
+        self.job_queue = job_queue
+        self.outbox = outbox
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._global_bucket = TokenBucket(global_rate, global_burst)
+        self._chat_buckets = dict()
+        self._lanes = [deque() for _ in priority_names]
+        self._paused_until = [0 for _ in priority_names]
+        self._cond = threading.Condition()
+        self._sent = 0
+        self._total_wait = 0
+        self._max_wait = 0
+        self._retried = 0
+        self._failed = 0
+        # Delivery status of the messages with a user to notify about failures
+        self._fanouts = dict()
+        # Number of queued messages for each tag, and tags to be discarded
+        self._tag_counts = dict()
+        self._revoked = set()
+        self._revoked_count = 0
+        self._running = True
+        self._workers = workers
+        self._in_flight = 0
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix='MessageSender')
+        if outbox:
+            self._replay_outbox()
+        self._thread = threading.Thread(target=self._run, name='MessageQueue',
+                                        daemon=True)
+        self._thread.start()
+        deletion_listeners.append(self.revoke)
+
+    def put(self, chat_ids, message_dict, priority=PRIORITY_NOTIFICATION):
+        """Enqueues a message for each of the given chats.
+
+        Parameters
+        ----------
+        chat_ids : list
+            chat IDs of the receivers.
+        message_dict : dict
+            Message parameters, as expected by `send_queued_message`, except
+            for the 'chat_id' key. It can have a 'tag' key with the database
+            path of the trip or request the message refers to.
+        priority : int
+            Priority class of the message, one of the PRIORITY_* constants.
+
+        Returns
+        -------
+        None
+
+        """
+        chat_ids = [str(id) for id in chat_ids]
+        if not chat_ids:
+            return
+        # Follow the delivery of all the receivers to report failures at once
+        if message_dict.get('notify_id') != None:
+            # Unique across restarts, since it is stored in the outbox
+            fanout_id = uuid.uuid4().hex
+            with self._cond:
+                self._fanouts[fanout_id] = {'notify_id': message_dict['notify_id'],
+                                            'pending': len(chat_ids), 'failed': []}
+            message_dict = dict(message_dict, fanout_id=fanout_id)
+        # Store all the messages at once before accepting them
+        if self.outbox:
+            outbox_ids = self.outbox.add(chat_ids, message_dict, priority,
+                                            message_dict.get('tag'))
+        else:
+            outbox_ids = [None]*len(chat_ids)
+        now = monotonic()
+        with self._cond:
+            self._track(message_dict.get('tag'), len(chat_ids))
+            for id, outbox_id in zip(chat_ids, outbox_ids):
+                self._lanes[priority].append(QueuedMessage(now, id, message_dict,
+                                                            outbox_id, 0, 0))
+            self._cond.notify()
+
+    def requeue(self, chat_id, message_dict, outbox_id, priority, attempt, delay=0):
+        """Puts a message that could not be sent back at the front of its lane.
+
+        Parameters
+        ----------
+        chat_id : str
+            chat ID of the receiver.
+        message_dict : dict
+            Message parameters.
+        outbox_id : int
+            Outbox ID of the message, or None.
+        priority : int
+            Priority class of the message.
+        attempt : int
+            Number of failed attempts to send the message.
+        delay : float
+            Seconds to wait before sending it again.
+
+        Returns
+        -------
+        None
+
+        """
+        now = monotonic()
+        with self._cond:
+            self._retried += 1
+            self._track(message_dict.get('tag'), 1)
+            self._lanes[priority].appendleft(QueuedMessage(now, chat_id,
+                                message_dict, outbox_id, attempt, now+delay))
+            self._cond.notify()
+
+    def revoke(self, tags):
+        """Discards the queued messages with any of the given tags.
+
+        Parameters
+        ----------
+        tags : list(str)
+            Tags of the messages to discard, i.e. database paths of deleted
+            trips or requests.
+
+        Returns
+        -------
+        None
+
+        """
+        with self._cond:
+            revoked = [tag for tag in tags if tag in self._tag_counts]
+            self._revoked.update(revoked)
+            if revoked:
+                self._cond.notify()
+        if self.outbox:
+            for tag in revoked:
+                self.outbox.revoke(tag)
+
+    def _track(self, tag, count):
+        """Updates the number of queued messages with a tag. Must be called
+        with the lock held."""
+        if tag is None:
+            return
+        count += self._tag_counts.get(tag, 0)
+        if count > 0:
+            self._tag_counts[tag] = count
+        else:
+            self._tag_counts.pop(tag, None)
+            self._revoked.discard(tag)
+
+    def _drop_revoked(self):
+        """Removes the revoked messages from the lanes. Must be called with
+        the lock held."""
+        for priority, lane in enumerate(self._lanes):
+            kept = deque()
+            for message in lane:
+                tag = message.message_dict.get('tag')
+                if tag in self._revoked:
+                    self._revoked_count += 1
+                    self._track(tag, -1)
+                    # A revoked message may be the last one of its fan-out
+                    notify_id = message.message_dict.get('notify_id')
+                    failed_ids = self.complete(message.message_dict.get('fanout_id'),
+                                                message.chat_id, True)
+                    if notify_id is not None and failed_ids:
+                        self._executor.submit(self._notify_undelivered,
+                                                notify_id, failed_ids)
+                else:
+                    kept.append(message)
+            self._lanes[priority] = kept
+
+    def pause(self, priority, seconds):
+        """Stops sending the messages of a lane for some seconds."""
+        with self._cond:
+            self._paused_until[priority] = max(self._paused_until[priority],
+                                                monotonic()+seconds)
+            self._cond.notify()
+
+    def complete(self, fanout_id, chat_id, delivered):
+        """Records the final delivery status of one of the receivers of a
+        message with a user to notify about failures.
+
+        Parameters
+        ----------
+        fanout_id : str
+            Identifier given to the message when it was queued.
+        chat_id : str
+            chat ID of the receiver.
+        delivered : boolean
+            Whether the message could be delivered to this receiver.
+
+        Returns
+        -------
+        list(str)
+            chat IDs of the receivers to which the message could not be
+            delivered, once the delivery to all of them has finished and some
+            of them failed. None otherwise.
+
+        """
+        with self._cond:
+            fanout = self._fanouts.get(fanout_id)
+            if fanout is None:
+                return None if delivered else [chat_id]
+            fanout['pending'] -= 1
+            if not delivered:
+                fanout['failed'].append(chat_id)
+            if fanout['pending'] > 0:
+                return None
+            del self._fanouts[fanout_id]
+            return fanout['failed'] or None
+
+    def mark_sent(self, outbox_id):
+        """Records a message as sent in the outbox, if any."""
+        if self.outbox and outbox_id:
+            self.outbox.mark_sent(outbox_id)
+
+    def mark_failed(self, outbox_id, error):
+        """Records a message as permanently failed."""
+        with self._cond:
+            self._failed += 1
+        if self.outbox and outbox_id:
+            self.outbox.mark_failed(outbox_id, error)
+
+    def _replay_outbox(self):
+        """Queues again the messages that were pending in the outbox."""
+        self.outbox.purge()
+        pending = self.outbox.pending()
+        now = monotonic()
+        for outbox_id, id, priority, message_dict, tag in pending:
+            self._track(tag, 1)
+            # Keep following the receivers that were still pending
+            fanout_id = message_dict.get('fanout_id')
+            if fanout_id is not None:
+                fanout = self._fanouts.setdefault(fanout_id,
+                            {'notify_id': message_dict.get('notify_id'),
+                             'pending': 0, 'failed': []})
+                fanout['pending'] += 1
+            self._lanes[priority].append(QueuedMessage(now, id, message_dict,
+                                                        outbox_id, 0, 0))
+        if pending:
+            logger.info(f"{len(pending)} pending messages loaded from the outbox.")
+
+    def stop(self):
+        """Stops the dispatcher thread. Pending messages are not sent."""
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        self._executor.shutdown(wait=False)
+        if self.outbox:
+            self.outbox.flush()
+
+    def stats(self):
+        """Returns a dictionary with the number of queued messages (in total
+        and by priority class), the number of sent messages, and the average
+        and maximum time that messages waited in the queue, and the number of
+        retried, failed and revoked messages. If there is an
+        outbox, the number of its messages in each state is also included."""
+        with self._cond:
+            queued = {name: len(lane) for name, lane in zip(priority_names, self._lanes)}
+            stats = {'queued': sum(queued.values()), 'queued_by_priority': queued,
+                     'sent': self._sent,
+                     'avg_wait': self._total_wait/self._sent if self._sent else 0,
+                     'max_wait': self._max_wait, 'retried': self._retried,
+                     'failed': self._failed, 'revoked': self._revoked_count}
+        if self.outbox:
+            stats['outbox'] = self.outbox.counts()
+        return stats
+
+    def _chat_bucket(self, id):
+        bucket = self._chat_buckets.get(id)
+        if bucket is None:
+            bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self._chat_buckets[id] = bucket
+        return bucket
+
+    def _next_ready(self, now):
+        """Looks for the oldest message of the highest priority lane whose chat
+        has an available token, skipping paused lanes and messages waiting to
+        be retried. Returns its priority and index in its lane and, if there
+        is none, the seconds until one of them will be ready."""
+        waits = []
+        checked = set()
+        for priority, lane in enumerate(self._lanes):
+            paused_until = self._paused_until[priority]
+            if lane and paused_until > now:
+                waits.append(paused_until-now)
+                continue
+            for index, message in enumerate(lane):
+                if message.not_before > now:
+                    waits.append(message.not_before-now)
+                    continue
+                if message.chat_id in checked:
+                    continue
+                checked.add(message.chat_id)
+                wait = self._chat_bucket(message.chat_id).wait_time(now)
+                if wait == 0:
+                    return (priority, index), 0
+                waits.append(wait)
+        return None, min(waits)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._running and (not any(self._lanes) or
+                                         self._in_flight >= self._workers):
+                    self._cond.wait()
+                if not self._running:
+                    return
+                if self._revoked:
+                    self._drop_revoked()
+                    if not any(self._lanes):
+                        continue
+                now = monotonic()
+                wait = self._global_bucket.wait_time(now)
+                if wait == 0:
+                    position, wait = self._next_ready(now)
+                if wait:
+                    self._cond.wait(wait)
+                    continue
+                priority, index = position
+                message = self._lanes[priority][index]
+                del self._lanes[priority][index]
+                id = message.chat_id
+                self._global_bucket.consume(now)
+                self._chat_buckets[id].consume(now)
+                self._sent += 1
+                self._total_wait += now-message.enqueued
+                self._max_wait = max(self._max_wait, now-message.enqueued)
+                self._track(message.message_dict.get('tag'), -1)
+                self._in_flight += 1
+                # Forget idle chats to keep the buckets dictionary small
+                if len(self._chat_buckets) > 1000:
+                    self._chat_buckets = {chat: bucket for chat, bucket
+                                in self._chat_buckets.items() if not bucket.is_full(now)}
+            self._executor.submit(self._send, dict(message.message_dict,
+                        chat_id=[id], priority=priority,
+                        outbox_id=message.outbox_id, attempt=message.attempt))
+
+    def _notify_undelivered(self, notify_id, chat_ids):
+        """Reports undelivered messages from one of the sending threads."""
+        try:
+            notify_undelivered(CallbackContext(self.job_queue._dispatcher),
+                                notify_id, chat_ids)
+        except Exception as e:
+            logger.warning(f"Undelivered messages could not be notified to"\
+                           f" {notify_id}: {str(e)}")
+
+    def _send(self, message_dict):
+        """Sends a message from one of the sending threads."""
+        try:
+            send_queued_message(CallbackContext(self.job_queue._dispatcher),
+                                message_dict)
+        except Exception as e:
+            logger.warning(f"Message to {message_dict['chat_id']} could not be"\
+                           f" sent: {str(e)}")
+        finally:
+            with self._cond:
+                self._in_flight -= 1
+                self._cond.notify()
+
+def get_message_queue(context):
+    """Gets the bot's message queue, creating it the first time.
+
+    Parameters
+    ----------
+    context : CallbackContext
+        The callback context from the handler from which this function is called.
+
+    Returns
+    -------
+    MessageQueue
+        The message queue stored in `bot_data`.
+
+    """
+    with _mq_lock:
+        if 'message_queue' not in context.bot_data:
+            context.bot_data['message_queue'] = MessageQueue(context.job_queue,
+                                                        Outbox(MQ_OUTBOX_PATH))
+        return context.bot_data['message_queue']
+
+def classify_send_error(error):
+    """Classifies an error raised when sending a message.
+
+    Parameters
+    ----------
+    error : Exception
+        The raised error.
+
+    Returns
+    -------
+    str
+        ERROR_RETRY_AFTER if Telegram's flood limit was exceeded,
+        ERROR_TRANSIENT if sending it again later may work, or
+        ERROR_PERMANENT otherwise (blocked bot, chat not found...).
+
+    """
+    if isinstance(error, RetryAfter):
+        return ERROR_RETRY_AFTER
+    # BadRequest is also a NetworkError, so it must be checked before
+    if isinstance(error, (Unauthorized, BadRequest)):
+        return ERROR_PERMANENT
+    if isinstance(error, NetworkError):     # TimedOut included
+        return ERROR_TRANSIENT
+    return ERROR_PERMANENT
+
+def is_unreachable_error(error):
+    """Checks whether an error means that no message can be delivered to the
+    chat anymore, because the user blocked the bot or the chat doesn't exist."""
+    return isinstance(error, Unauthorized) or (isinstance(error, BadRequest)
+                                and 'chat not found' in str(error).lower())
+
+def get_backoff_delay(attempt):
+    """Returns the seconds to wait before retrying a message for the given
+    attempt number, growing exponentially and with random jitter."""
+    delay = min(MQ_BACKOFF_MAX, MQ_BACKOFF_BASE*2**attempt)
+    return delay/2 + random.uniform(0, delay/2)
+
+def send_queued_message(context, message_dict):
+    """Sends a message taken from the message queue, requeuing it or marking
+    it as failed if it can't be delivered.
+
+    Parameters
+    ----------
+    context : CallbackContext
+        Context of the bot's dispatcher.
+    message_dict : dict
+        Message parameters, with the receiver in the 'chat_id' key and its
+        'priority', 'outbox_id' and 'attempt' in the queue.
+
+    Returns
+    -------
+    None
+
+    """
     chat_id = message_dict['chat_id']
     text = message_dict['text']
     parse_mode = message_dict['parse_mode']
     reply_markup = message_dict['reply_markup']
+    message_queue = context.bot_data['message_queue']
+    outbox_id = message_dict.get('outbox_id')
+    priority = message_dict.get('priority', PRIORITY_NOTIFICATION)
+    attempt = message_dict.get('attempt', 0)
     # Send messages
     for id in chat_id:
         try:
             context.bot.send_message(id, text, parse_mode,
                                         reply_markup=reply_markup)
+            message_queue.mark_sent(outbox_id)
+            complete_delivery(context, message_dict, id, True)
+            continue
         except Exception as e:
-            text2 = f"{str(e)}\nMessage could not be sent to user with chat_id {id}"\
+            error = e
+        error_type = classify_send_error(error)
+        if error_type == ERROR_RETRY_AFTER:
+            # Stop the whole lane until Telegram allows sending again
+            logger.info(f"Flood limit exceeded, pausing {priority_names[priority]}"\
+                        f" messages for {error.retry_after} s.")
+            message_queue.pause(priority, error.retry_after)
+            message_queue.requeue(id, message_dict, outbox_id, priority, attempt)
+        elif error_type == ERROR_TRANSIENT and attempt < MQ_MAX_RETRIES:
+            delay = get_backoff_delay(attempt)
+            logger.info(f"{str(error)}\nMessage to user with chat_id {id} will "\
+                        f"be retried in {delay:.1f} s.")
+            message_queue.requeue(id, message_dict, outbox_id, priority,
+                                    attempt+1, delay)
+        else:
+            message_queue.mark_failed(outbox_id, error)
+            if is_unreachable_error(error):
+                # Don't waste more messages on this user until they come back
+                set_unreachable(id)
+            text2 = f"{str(error)}\nMessage could not be sent to user with chat_id {id}"\
                     f" and text:\n{text}"
             logger.warning(text2)
-            # Notify is necessary about not delivered messages
-            if 'notify_id' in message_dict:
-                text3 = f"🚫 No se ha podido enviar el mensaje a "\
-                       f"{get_markdown2_inline_mention(id)}\. 🚫\n"\
-                       f"Por favor, si lo ves necesario, contáctale por privado\."
-                send_message(context, message_dict['notify_id'], text3,
-                                            telegram.ParseMode.MARKDOWN_V2)
+            complete_delivery(context, message_dict, id, False)
+
+def complete_delivery(context, message_dict, chat_id, delivered):
+    """Records the final delivery status of a message for one of its receivers
+    and, once all of them have been tried, notifies the ones that could not
+    receive it to the user in its 'notify_id', if any.
+
+    Parameters
+    ----------
+    context : CallbackContext
+        Context of the bot's dispatcher.
+    message_dict : dict
+        Message parameters.
+    chat_id : str
+        chat ID of the receiver.
+    delivered : boolean
+        Whether the message could be delivered to this receiver.
+
+    Returns
+    -------
+    None
+
+    """
+    if 'notify_id' not in message_dict:
+        return
+    # The last receiver to finish may be a delivered one, which still has to
+    # report the failures of the others
+    failed_ids = context.bot_data['message_queue'].complete(
+                                message_dict.get('fanout_id'), chat_id, delivered)
+    if failed_ids:
+        notify_undelivered(context, message_dict['notify_id'], failed_ids)
+
+def notify_undelivered(context, notify_id, chat_ids):
+    """Sends a single message reporting the users to whom a message could
+    not be delivered.
+
+    Parameters
+    ----------
+    context : CallbackContext
+        The callback context from which this function is called.
+    notify_id : int or str
+        chat ID of the user to notify.
+    chat_ids : list
+        chat IDs of the users to whom the message could not be delivered.
+
+    Returns
+    -------
+    None
+
+    """
+    names = get_names(chat_ids)
+    mentions = [get_markdown2_inline_mention(id, names.get(str(id))) for id in chat_ids]
+    if len(mentions) == 1:
+        text = f"🚫 No se ha podido enviar el mensaje a {mentions[0]}\. 🚫\n"\
+               f"Por favor, si lo ves necesario, contáctale por privado\."
+    else:
+        text = f"🚫 No se ha podido enviar el mensaje a los siguientes usuarios: 🚫\n"
+        text += "\n".join(f"\- {mention}" for mention in mentions)
+        text += f"\nPor favor, si lo ves necesario, contáctales por privado\."
+    send_message(context, notify_id, text, telegram.ParseMode.MARKDOWN_V2,
+                    priority=PRIORITY_TRANSACTIONAL)
 
 def send_message(context, chat_id, text, parse_mode=None,
-                reply_markup=None, notify_id=None):
+                reply_markup=None, notify_id=None, priority=PRIORITY_NOTIFICATION,
+                tag=None):
     """Send messages without hitting Telegram's flood limit.
 
     Parameters
@@ -50,39 +665,31 @@ def send_message(context, chat_id, text, parse_mode=None,
     notify_id : int or str
         chat ID of the user to be notified in case the message(s) could not
         be delivered. Optional
+    priority : int
+        Priority class of the message, one of the PRIORITY_* constants.
+        Messages of higher classes are sent first. Optional, notification
+        priority by default.
+    tag : str
+        Database path of the trip or request the message refers to. If it is
+        deleted before the message is sent, the message is discarded. Optional.
 
     Returns
     -------
     None
     """
-    # Obtain current datetime
-    now = datetime.now(madrid)
-    # Obtain time for sending the message, preventing flood limit
-    if 'next_mq_time' in context.bot_data and now < context.bot_data['next_mq_time']:
-        m_time = context.bot_data['next_mq_time']
-    else:
-        m_time = now
     # Admit unique or list of chat_id's
     if type(chat_id) != list:
         chat_id = [chat_id]
 
-    msgs_per_sec = math.floor(1000000/minimum_time_delta.microseconds)
-    # Program message for each user in bursts of messages that fill in a second
-    for index in range(math.ceil(len(chat_id)/msgs_per_sec)):
-        # Create dictionary with message parameters
-        message_dict = {'chat_id': chat_id[index*msgs_per_sec:(index+1)*msgs_per_sec],
-                        'text': text,
-                        'parse_mode': parse_mode,
-                        'reply_markup': reply_markup}
-        # If user_id to notify in case of failure is set, add to dict
-        if notify_id != None:
-            message_dict['notify_id'] = notify_id
-        num_chats = len(message_dict['chat_id'])
-        # Queue job
-        context.job_queue.run_once(callback_send_message, m_time, message_dict,
-            name=f"Job ID{chat_id[index*msgs_per_sec]} #{num_chats} Time{m_time}")
-        # Increment time for next message
-        m_time += minimum_time_delta*num_chats
-    # Set minimum time for next message
-    context.bot_data['next_mq_time'] = m_time
+    # Create dictionary with message parameters
+    message_dict = {'text': text,
+                    'parse_mode': parse_mode,
+                    'reply_markup': reply_markup}
+    # If user_id to notify in case of failure is set, add to dict
+    if notify_id != None:
+        message_dict['notify_id'] = notify_id
+    if tag != None:
+        message_dict['tag'] = tag
+    # Queue the message for every user
+    get_message_queue(context).put(chat_id, message_dict, priority)
     return
@@ -1,25 +1,37 @@
-import logging, telegram, math
+import logging, telegram, math, threading
 from os import environ
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.constants import MAX_MESSAGE_LENGTH
 from telegram.ext import CallbackContext
 from telegram.utils.helpers import escape_markdown
 from datetime import datetime
 from data.database_api import (is_driver, delete_user, delete_driver,
-                                get_trips_by_driver, get_trip_passengers,
+                                get_trip, get_trips_by_driver, get_trip_passengers,
                                 delete_trip, remove_passenger,
                                 get_slots, get_fee,
                                 get_users_for_offer_notification,
                                 get_users_for_request_notification,
-                                get_requests_by_date_range)
+                                get_requests_by_date_range, filter_reachable,
+                                deletion_listeners)
 from messages.format import (get_formatted_trip_for_passenger,
                              get_formatted_trip_for_driver,
                              format_trip_from_data, format_request_from_data,
                              get_markdown2_inline_mention)
-from messages.message_queue import send_message
+from messages.message_queue import (send_message, PRIORITY_INTERACTIVE,
+                                    PRIORITY_TRANSACTIONAL)
 from utils.common import *
 
 logger = logging.getLogger(__name__)
 
+# Seconds during which the new trip notifications for the same user are merged
+# into a single message. If 0, every trip is notified as soon as it is published.
+NOTIFICATION_DIGEST_WINDOW = int(environ.get('NOTIFICATION_DIGEST_WINDOW', '0'))
+_digest_lock = threading.Lock()
+# Pending trips for each user, and database paths of the trips deleted meanwhile.
+# They are only kept in memory, so the pending digests are lost on restart
+_trips_digests = dict()
+_revoked_digest_trips = set()
+
 def notify_new_trip(context, trip_key, direction, chat_id, date, time,
                         slots=None, fee=None, origin=None, dest=None):
     if not slots:
@@ -27,12 +39,8 @@ def notify_new_trip(context, trip_key, direction, chat_id, date, time,
     if not fee:
         fee = get_fee(chat_id)
 
-    text = "🔵 Se ha publicado un *nuevo viaje*:\n\n"
-    text += format_trip_from_data(direction, date, chat_id, time, slots,
+    trip_text = format_trip_from_data(direction, date, chat_id, time, slots,
                                         fee=fee, origin=origin, dest=dest)
-    text += f"\n\nPuedes ver todos los viajes ofertados mediante"\
-           f" el comando /verofertas\. Si estás interesado en este viaje"\
-           f" puedes mandar una solicitud de reserva desde este mensaje:"
 
     # Obtain list of interested users for this trip
     weekday = weekdays[datetime.fromisoformat(date).weekday()]
@@ -45,18 +53,158 @@ def notify_new_trip(context, trip_key, direction, chat_id, date, time,
         req_user_ids = [str(req_dict[key]['Chat ID']) for key in req_dict]
         user_ids = list(set(user_ids)|set(req_user_ids))
 
-    # Make sure that the driver doesn't get notified
-    user_ids = list(set(user_ids)-set([str(chat_id)]))
+    # Make sure that the driver and the users who blocked the bot don't get notified
+    user_ids = filter_reachable(list(set(user_ids)-set([str(chat_id)])))
+
+    trip = (direction, date, trip_key, trip_text)
+    if NOTIFICATION_DIGEST_WINDOW > 0:
+        add_to_trips_digest(context, user_ids, trip)
+    else:
+        text, reply_markup = get_new_trips_message([trip])
+        # If the trip is deleted in the meantime, the notifications are discarded
+        send_message(context, user_ids, text, telegram.ParseMode.MARKDOWN_V2,
+                        reply_markup=reply_markup,
+                        tag=f"/Trips/{direction}/{date}/{trip_key}")
+
+def get_new_trips_message(trips):
+    """Generates the notification message for one or several new trips.
+
+    Parameters
+    ----------
+    trips : list of tuples
+        List of (direction, date, trip_key, trip_text) tuples, where trip_text
+        is the trip formatted with `format_trip_from_data`.
+
+    Returns
+    -------
+    (str, InlineKeyboardMarkup)
+        The Markdown V2 text of the message and its keyboard, with a booking
+        button for each trip.
 
+    """
     cbd = "RSV"
-    keyboard = [[InlineKeyboardButton("✅ Solicitar reserva",
-                    callback_data=ccd(cbd, direction[2:5].upper(), date, trip_key)),
-                 InlineKeyboardButton("❌ Descartar",
-                    callback_data=ccd(cbd, "DISMISS"))]]
-    send_message(context, user_ids, text, telegram.ParseMode.MARKDOWN_V2,
-                    reply_markup=InlineKeyboardMarkup(keyboard))
-
-def notify_new_request(context, direction, chat_id, date, time):
+    if len(trips) == 1:
+        direction, date, trip_key, trip_text = trips[0]
+        text = "🔵 Se ha publicado un *nuevo viaje*:\n\n" + trip_text
+        text += f"\n\nPuedes ver todos los viajes ofertados mediante"\
+               f" el comando /verofertas\. Si estás interesado en este viaje"\
+               f" puedes mandar una solicitud de reserva desde este mensaje:"
+        keyboard = [[InlineKeyboardButton("✅ Solicitar reserva",
+                    callback_data=ccd(cbd, direction[2:5].upper(), date, trip_key))]]
+    else:
+        text = f"🔵 Se han publicado *{len(trips)} nuevos viajes*:"
+        keyboard = []
+        for i, (direction, date, trip_key, trip_text) in enumerate(trips, 1):
+            text += f"\n\n*{i}\)* {trip_text}"
+            keyboard.append([InlineKeyboardButton(f"✅ Solicitar reserva ({i})",
+                    callback_data=ccd(cbd, direction[2:5].upper(), date, trip_key))])
+        text += f"\n\nPuedes ver todos los viajes ofertados mediante"\
+               f" el comando /verofertas\. Si estás interesado en alguno de estos"\
+               f" viajes puedes mandar una solicitud de reserva desde este mensaje:"
+    keyboard[-1].append(InlineKeyboardButton("❌ Descartar",
+                                            callback_data=ccd(cbd, "DISMISS")))
+    return text, InlineKeyboardMarkup(keyboard)
+
+def add_to_trips_digest(context, user_ids, trip):
+    """Adds a new trip to the pending digest of each user. The digests are
+    sent when the digest window that started with the first pending trip ends.
+
+    Parameters
+    ----------
+    context : CallbackContext
+        The callback context from the handler from which this function is called.
+    user_ids : list
+        chat IDs of the users to notify.
+    trip : tuple
+        (direction, date, trip_key, trip_text) tuple of the new trip.
+
+    Returns
+    -------
+    None
+
+    """
+    if not user_ids:
+        return
+    with _digest_lock:
+        # The first pending trip starts the digest window
+        if not _trips_digests:
+            context.job_queue.run_once(callback_send_trips_digests,
+                                    NOTIFICATION_DIGEST_WINDOW, name="Trips digest")
+        for id in user_ids:
+            _trips_digests.setdefault(str(id), []).append(trip)
+
+def revoke_digest_trips(paths):
+    """Deletion listener that discards the deleted trips from the pending
+    digests."""
+    with _digest_lock:
+        if _trips_digests:
+            _revoked_digest_trips.update(path for path in paths
+                                            if path.startswith('/Trips/'))
+
+def split_trips_digest(trips):
+    """Splits the trips of a digest into groups whose notification message
+    fits within Telegram's maximum message length.
+
+    Parameters
+    ----------
+    trips : list of tuples
+        List of (direction, date, trip_key, trip_text) tuples.
+
+    Returns
+    -------
+    list(list)
+        Groups of consecutive trips, each one for a message.
+
+    """
+    groups = []
+    for trip in trips:
+        if groups:
+            text, _ = get_new_trips_message(groups[-1] + [trip])
+            if len(text) <= MAX_MESSAGE_LENGTH:
+                groups[-1].append(trip)
+                continue
+        groups.append([trip])
+    return groups
+
+def callback_send_trips_digests(context):
+    """Sends the pending new trips digests, with one message for each user
+    (or several of them if the digest is too long)."""
+    with _digest_lock:
+        digests = dict(_trips_digests)
+        revoked = set(_revoked_digest_trips)
+        _trips_digests.clear()
+        _revoked_digest_trips.clear()
+
+    # Messages with several trips can't be revoked through their tag, so the
+    # trips deleted before sending them are discarded here
+    existing = dict()
+    for trips in digests.values():
+        for trip in trips:
+            path = f"/Trips/{trip[0]}/{trip[1]}/{trip[2]}"
+            if path not in existing:
+                existing[path] = path not in revoked and \
+                                 get_trip(trip[0], trip[1], trip[2]) is not None
+
+    # Users with the same trips get the same messages, so queue them together
+    groups = dict()
+    for id, trips in digests.items():
+        trips = tuple(trip for trip in trips
+                        if existing[f"/Trips/{trip[0]}/{trip[1]}/{trip[2]}"])
+        if trips:
+            groups.setdefault(trips, []).append(id)
+    for trips, user_ids in groups.items():
+        for message_trips in split_trips_digest(list(trips)):
+            text, reply_markup = get_new_trips_message(message_trips)
+            tag = None
+            if len(message_trips) == 1:
+                tag = f"/Trips/{message_trips[0][0]}/{message_trips[0][1]}/"\
+                      f"{message_trips[0][2]}"
+            send_message(context, user_ids, text, telegram.ParseMode.MARKDOWN_V2,
+                            reply_markup=reply_markup, tag=tag)
+
+deletion_listeners.append(revoke_digest_trips)
+
+def notify_new_request(context, direction, chat_id, date, time, request_key=None):
     text = "🔴 Se ha publicado una *nueva petición* de viaje:\n\n"
     text += format_request_from_data(direction, date, chat_id, time)
     text2 = f"\n\nSi estás interesado en publicar una oferta para satisfacer"\
@@ -70,10 +218,12 @@ def notify_new_request(context, direction, chat_id, date, time):
     weekday = weekdays[datetime.fromisoformat(date).weekday()]
     user_ids = get_users_for_request_notification(direction, weekday)
 
-    # Make sure that the requester doesn't get notified
-    user_ids = list(set(user_ids)-set([str(chat_id)]))
+    # Make sure that the requester and the users who blocked the bot don't get notified
+    user_ids = filter_reachable(list(set(user_ids)-set([str(chat_id)])))
 
-    send_message(context, user_ids, text, telegram.ParseMode.MARKDOWN_V2)
+    # If the request is deleted in the meantime, the notifications are discarded
+    tag = f"/Requests/{direction}/{date}/{request_key}" if request_key else None
+    send_message(context, user_ids, text, telegram.ParseMode.MARKDOWN_V2, tag=tag)
 
 def delete_trip_notify(update, context, direction, date, key):
     # Notify possible passengers
@@ -81,14 +231,16 @@ def delete_trip_notify(update, context, direction, date, key):
 
     if passenger_ids:
         text_driver = f"Avisando a los pasajeros..."
-        send_message(context, update.effective_chat.id, text_driver)
+        send_message(context, update.effective_chat.id, text_driver,
+                            priority=PRIORITY_INTERACTIVE)
         text_passenger = f"🚫 El siguiente viaje, en el que te habían "\
                          f"aceptado como pasajero, ha sido anulado:\n\n"
         text_passenger = escape_markdown(text_passenger,2)
         text_passenger += get_formatted_trip_for_passenger(direction, date, key)
         send_message(context, passenger_ids, text_passenger,
                             telegram.ParseMode.MARKDOWN_V2,
-                            notify_id=update.effective_chat.id)
+                            notify_id=update.effective_chat.id,
+                            priority=PRIORITY_TRANSACTIONAL)
 
     delete_trip(direction, date, key)
 
@@ -99,7 +251,8 @@ def remove_passenger_notify(update, context, passenger_id, direction, date, key)
     text_passenger += get_formatted_trip_for_passenger(direction, date, key)
     send_message(context, passenger_id, text_passenger,
                         telegram.ParseMode.MARKDOWN_V2,
-                        notify_id=update.effective_chat.id)
+                        notify_id=update.effective_chat.id,
+                        priority=PRIORITY_TRANSACTIONAL)
 
 def delete_driver_notify(update, context, chat_id):
     week_strings = week_isoformats()
@@ -108,7 +261,7 @@ def delete_driver_notify(update, context, chat_id):
     # Notify possible passengers
     if trips_dict:
         text = "Anulando todos los viajes pendientes y notificando a sus pasajeros..."
-        send_message(context, chat_id, text)
+        send_message(context, chat_id, text, priority=PRIORITY_INTERACTIVE)
         for dir in trips_dict:
             for date in trips_dict[dir]:
                 for key in trips_dict[dir][date]:
@@ -124,7 +277,8 @@ def delete_driver_notify(update, context, chat_id):
                             text_passenger += get_formatted_trip_for_passenger(dir, date, key)
                             send_message(context, list(passenger_ids), text_passenger,
                                                 telegram.ParseMode.MARKDOWN_V2,
-                                                notify_id=update.effective_chat.id)
+                                                notify_id=update.effective_chat.id,
+                                                priority=PRIORITY_TRANSACTIONAL)
 
     # This function already deletes all the trips
     delete_driver(chat_id)
@@ -136,7 +290,7 @@ def delete_user_notify(update, context, chat_id):
     # Notify possible reservations' drivers
     if trips_dict:
         text = "Anulando todas tus reservas pendientes y notificando a sus conductores..."
-        send_message(context, chat_id, text)
+        send_message(context, chat_id, text, priority=PRIORITY_INTERACTIVE)
         for dir in trips_dict:
             for date in trips_dict[dir]:
                 for key in trips_dict[dir][date]:
@@ -158,7 +312,8 @@ def delete_user_notify(update, context, chat_id):
                         text_driver += get_formatted_trip_for_driver(dir, date, key)
                         send_message(context, driver_id, text_driver,
                                             telegram.ParseMode.MARKDOWN_V2,
-                                            notify_id=update.effective_chat.id)
+                                            notify_id=update.effective_chat.id,
+                                            priority=PRIORITY_TRANSACTIONAL)
 
     # Delete driver settings and trips if necessary
     if is_driver(chat_id):
@@ -0,0 +1,238 @@
+import logging, json, sqlite3, telegram, threading
+from time import time
+
+logger = logging.getLogger(__name__)
+
+# Sent messages are kept for this many seconds before being purged
+SENT_RETENTION = 24*3600
+# Sent and failed messages are recorded in a single transaction every this
+# many messages or seconds, instead of syncing the file once per message
+ACK_BATCH_SIZE = 50
+ACK_BATCH_DELAY = 0.5
+
+PENDING = 'pending'
+SENT = 'sent'
+FAILED = 'failed'
+REVOKED = 'revoked'
+
+def serialize_message(message_dict):
+    """Converts the parameters of a message into a JSON string.
+
+    Parameters
+    ----------
+    message_dict : dict
+        Message parameters, with the 'text', 'parse_mode', 'reply_markup'
+        and, optionally, 'notify_id' keys.
+
+    Returns
+    -------
+    str
+        JSON representation of the message.
+
+    """
+    data = dict(message_dict)
+    markup = data.get('reply_markup')
+    if markup is not None:
+        data['reply_markup'] = {'type': type(markup).__name__,
+                                'data': markup.to_dict()}
+    return json.dumps(data)
+
+def deserialize_message(payload, bot=None):
+    """Rebuilds the parameters of a message from its JSON string.
+
+    Parameters
+    ----------
+    payload : str
+        JSON representation of the message, as returned by `serialize_message`.
+    bot : telegram.Bot
+        Optional. Bot used to rebuild the reply markup.
+
+    Returns
+    -------
+    dict
+        Message parameters.
+
+    """
+    data = json.loads(payload)
+    markup = data.get('reply_markup')
+    if markup is not None:
+        data['reply_markup'] = getattr(telegram, markup['type']).de_json(
+                                                            markup['data'], bot)
+    return data
+
+class Outbox:
+    """Durable record of the outgoing messages, stored in a local SQLite file.
+
+    Every message accepted by the message queue is written here as pending
+    before being sent and marked as sent or failed afterwards, so the pending
+    ones can be queued again if the bot is restarted. Sent and failed marks
+    are written in batches, so the messages sent during the last
+    ACK_BATCH_DELAY seconds before a crash may be sent again.
+
+    Parameters
+    ----------
+    path : str
+        Path of the SQLite database file.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        # Sent and failed marks not written yet, and timer that writes them
+        self._acks = []
+        self._ack_timer = None
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=FULL")
+        with self._conn:
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS messages (
+                                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                    chat_id TEXT NOT NULL,
+                                    priority INTEGER NOT NULL,
+                                    payload TEXT NOT NULL,
+                                    state TEXT NOT NULL,
+                                    created REAL NOT NULL,
+                                    updated REAL NOT NULL,
+                                    error TEXT,
+                                    tag TEXT)""")
+            # Outbox files created before messages had tags
+            columns = [row[1] for row in self._conn.execute("PRAGMA table_info(messages)")]
+            if 'tag' not in columns:
+                self._conn.execute("ALTER TABLE messages ADD COLUMN tag TEXT")
+            self._conn.execute("""CREATE INDEX IF NOT EXISTS messages_state
+                                    ON messages (state, id)""")
+            self._conn.execute("""CREATE INDEX IF NOT EXISTS messages_tag
+                                    ON messages (tag, state)""")
+
+    def add(self, chat_ids, message_dict, priority, tag=None):
+        """Stores a message as pending for each of the given chats, in a single
+        transaction.
+
+        Parameters
+        ----------
+        chat_ids : list
+            chat IDs of the receivers.
+        message_dict : dict
+            Message parameters.
+        priority : int
+            Priority class of the message.
+        tag : str
+            Optional. Database path of the trip or request the message refers to.
+
+        Returns
+        -------
+        list(int)
+            Outbox IDs of the stored messages, in the same order as chat_ids.
+
+        """
+        payload = serialize_message(message_dict)
+        now = time()
+        with self._lock, self._conn:
+            self._write_acks()
+            cursor = self._conn.execute("SELECT COALESCE(MAX(id), 0) FROM messages")
+            first_id = cursor.fetchone()[0] + 1
+            self._conn.executemany("""INSERT INTO messages (id, chat_id, priority,
+                                        payload, state, created, updated, tag)
+                                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                    [(first_id+i, str(id), priority, payload, PENDING, now, now, tag)
+                                            for i, id in enumerate(chat_ids)])
+        return list(range(first_id, first_id+len(chat_ids)))
+
+    def _set_state(self, outbox_id, state, error=None):
+        with self._lock:
+            self._acks.append((state, time(), error, outbox_id))
+            if len(self._acks) >= ACK_BATCH_SIZE:
+                with self._conn:
+                    self._write_acks()
+            elif self._ack_timer is None:
+                self._ack_timer = threading.Timer(ACK_BATCH_DELAY, self.flush)
+                self._ack_timer.daemon = True
+                self._ack_timer.start()
+
+    def _write_acks(self):
+        """Writes the pending sent and failed marks. Must be called with the
+        lock held, within a transaction."""
+        if self._ack_timer is not None:
+            self._ack_timer.cancel()
+            self._ack_timer = None
+        if self._acks:
+            self._conn.executemany("""UPDATE messages SET state=?, updated=?, error=?
+                                    WHERE id=?""", self._acks)
+            self._acks = []
+
+    def flush(self):
+        """Writes the sent and failed marks that are waiting for their batch."""
+        with self._lock, self._conn:
+            self._write_acks()
+
+    def mark_sent(self, outbox_id):
+        """Marks a message as successfully sent."""
+        self._set_state(outbox_id, SENT)
+
+    def mark_failed(self, outbox_id, error):
+        """Marks a message as not deliverable, storing the error description."""
+        self._set_state(outbox_id, FAILED, str(error))
+
+    def revoke(self, tag):
+        """Marks the pending messages with the given tag as revoked, so they
+        are not sent anymore."""
+        with self._lock, self._conn:
+            self._write_acks()
+            self._conn.execute("""UPDATE messages SET state=?, updated=?
+                                    WHERE tag=? AND state=?""",
+                                    (REVOKED, time(), tag, PENDING))
+
+    def pending(self, bot=None):
+        """Gets the messages that have not been sent yet, oldest first.
+
+        Parameters
+        ----------
+        bot : telegram.Bot
+            Optional. Bot used to rebuild the messages' reply markups.
+
+        Returns
+        -------
+        list((int, str, int, dict, str))
+            Outbox ID, chat ID, priority, message parameters and tag of each
+            message.
+
+        """
+        with self._lock, self._conn:
+            self._write_acks()
+            rows = self._conn.execute("""SELECT id, chat_id, priority, payload, tag
+                                FROM messages WHERE state=? ORDER BY id""",
+                                (PENDING,)).fetchall()
+        pending = []
+        for outbox_id, chat_id, priority, payload, tag in rows:
+            try:
+                pending.append((outbox_id, chat_id, priority,
+                                deserialize_message(payload, bot), tag))
+            except Exception as e:
+                logger.warning(f"Outbox message {outbox_id} could not be loaded: {str(e)}")
+                self.mark_failed(outbox_id, e)
+        return pending
+
+    def purge(self, retention=SENT_RETENTION):
+        """Deletes the sent and revoked messages older than the retention time.
+
+        Returns
+        -------
+        int
+            Number of deleted messages.
+
+        """
+        with self._lock, self._conn:
+            self._write_acks()
+            cursor = self._conn.execute("""DELETE FROM messages
+                                    WHERE state IN (?, ?) AND updated<?""",
+                                    (SENT, REVOKED, time()-retention))
+        return cursor.rowcount
+
+    def counts(self):
+        """Returns the number of stored messages in each state."""
+        with self._lock, self._conn:
+            self._write_acks()
+            rows = self._conn.execute("""SELECT state, COUNT(*) FROM messages
+                                        GROUP BY state""").fetchall()
+        return {PENDING: 0, SENT: 0, FAILED: 0, REVOKED: 0, **dict(rows)}
@@ -0,0 +1,30 @@
+import unittest
+from data.storage import set_backend, MemoryBackend
+from data.request_scope import begin_request_scope, end_request_scope, _current_scope
+import data.database_api as database_api
+
+class RequestScopeTest(unittest.TestCase):
+
+    def setUp(self):
+        set_backend(MemoryBackend())
+
+    def tearDown(self):
+        end_request_scope()
+
+    def test_multi_path_update_invalidates_cached_reads(self):
+        key = database_api.add_trip('toUMA', 1, '2000-01-03', '09:00')
+        begin_request_scope('test')
+        self.assertIsNotNone(database_api.get_trip('toUMA', '2000-01-03', key))
+        database_api.delete_trip('toUMA', '2000-01-03', key)
+        self.assertIsNone(database_api.get_trip('toUMA', '2000-01-03', key))
+
+    def test_repeated_reads_are_cached(self):
+        key = database_api.add_trip('toUMA', 1, '2000-01-03', '09:00')
+        begin_request_scope('test')
+        database_api.get_trip('toUMA', '2000-01-03', key)
+        database_api.get_trip('toUMA', '2000-01-03', key)
+        scope = _current_scope.get()
+        self.assertEqual((scope.reads, scope.hits), (1, 1))
+
+if __name__ == '__main__':
+    unittest.main()
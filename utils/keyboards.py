@@ -1,7 +1,8 @@
 import logging, math
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
-from data.database_api import is_driver, get_name
-from messages.format import format_trip_from_data, format_request_from_data
+from data.database_api import is_driver, get_names
+from messages.format import (format_trip_from_data, format_request_from_data,
+                             prefetch_names)
 from utils.common import *
 
 def config_keyboard(chat_id):
@@ -226,6 +227,9 @@ def trips_keyboard(trips_dict, command, ikbs_list=None, show_extra_param=True,
     """
     cbd = ccd(command,'ID')
     keyboard = []
+    if show_passengers:
+        # Get the names of all the passengers at once
+        prefetch_names(trip for date in trips_dict for trip in trips_dict[date].values())
     for date in trips_dict:
         for key in trips_dict[date]:
             trip = trips_dict[date][key]
@@ -310,14 +314,16 @@ def passengers_keyboard(chat_id_list, cdh, ikbs_list=None):
     index = 0
     cbd = ccd(cdh,'PASS_ID')
     keyboard = []
+    names = get_names(chat_id_list)
     for i in range(n_rows):
         row = []
         for j in range(n_cols):
             # If no more items, dont try to append more to row
             if index==n_passengers:
                 continue
-            row.append(InlineKeyboardButton(get_name(chat_id_list[index]),
-                                callback_data=ccd(cbd,chat_id_list[index])))
+            passenger_id = chat_id_list[index]
+            row.append(InlineKeyboardButton(names.get(str(passenger_id), str(passenger_id)),
+                                callback_data=ccd(cbd,passenger_id)))
             index += 1
         keyboard.append(row)
 